@@ -0,0 +1,159 @@
+import logging
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+
+from django_common.core.mail.backends.queued import get_queue, \
+    DEFAULT_DELIVERY_BACKEND
+from django_common.core.queue.persistent import Empty
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    args = ''
+    option_list = BaseCommand.option_list + (
+        make_option('--path',
+            action='store',
+            dest='path',
+            default=None,
+            help='Location of the mail queue (default EMAIL_QUEUE_PATH)'),
+        make_option('--backend',
+            action='store',
+            dest='backend',
+            default=None,
+            help='Email backend to deliver with (default '
+                 'EMAIL_QUEUE_DELIVERY_BACKEND or the sendmail backend)'),
+        make_option('--batch-size',
+            action='store',
+            dest='batch-size',
+            type='int',
+            default=100,
+            help='Most messages delivered over one connection'),
+        make_option('--max-retries',
+            action='store',
+            dest='max-retries',
+            type='int',
+            default=5,
+            help='Times to retry a message before dropping it'),
+        make_option('--retry-delay',
+            action='store',
+            dest='retry-delay',
+            type='float',
+            default=30,
+            help='Seconds to pause after a failed delivery'),
+        make_option('--visibility-timeout',
+            action='store',
+            dest='visibility-timeout',
+            type='float',
+            default=None,
+            help='Seconds a worker has to deliver a batch before its '
+                 'messages are delivered again (default '
+                 'EMAIL_QUEUE_VISIBILITY_TIMEOUT or 30)'),
+        make_option('--once',
+            action='store_true',
+            dest='once',
+            default=False,
+            help='Exit once the queue is empty'),
+    )
+    help = 'Deliver messages spooled by the queued email backend'
+
+    def handle(self, *args, **options):
+        queue = get_queue(options['path'])
+        backend = options['backend'] or \
+                  getattr(settings, 'EMAIL_QUEUE_DELIVERY_BACKEND',
+                          DEFAULT_DELIVERY_BACKEND)
+        connection = get_connection(backend)
+        while True:
+            batch = self.reserve(queue, options)
+            if not batch:
+                break
+            connection.open()
+            try:
+                failed = self.deliver(connection, batch)
+            finally:
+                connection.close()
+            for id, (attempts, message) in batch:
+                if id in failed:
+                    self.retry(queue, id, attempts, message, failed[id],
+                               options)
+                else:
+                    self.settle(queue.ack, id)
+            if failed and options['retry-delay']:
+                time.sleep(options['retry-delay'])
+
+    def reserve(self, queue, options):
+        """
+        Wait for a message, then take up to batch-size messages without
+        waiting. Returns an empty list in --once mode if the queue is empty.
+        """
+        batch = []
+        while len(batch) < options['batch-size']:
+            try:
+                batch.append(queue.reserve(
+                    block=not batch and not options['once'],
+                    visibility_timeout=options['visibility-timeout']))
+            except Empty:
+                break
+        return batch
+
+    def deliver(self, connection, batch):
+        """
+        Send the messages of 'batch' and return a dict mapping the ids of
+        those that failed to the reason. Backends that report the outcome
+        of every message in 'results', like the sendmail backend, get the
+        whole batch in one call. Others only report how many messages of a
+        list they sent, so they get one message per call; retrying a list
+        they partly sent would send delivered messages again.
+        """
+        messages = [message for id, (attempts, message) in batch]
+        if hasattr(connection, 'results'):
+            error = None
+            try:
+                connection.send_messages(messages)
+            except Exception, e:
+                error = e
+            failed = {}
+            for (id, item), result in zip(batch, connection.results):
+                if result is not True:
+                    failed[id] = result or error or 'not sent'
+            return failed
+        failed = {}
+        for id, (attempts, message) in batch:
+            try:
+                if not connection.send_messages([message]):
+                    failed[id] = 'not sent'
+            except Exception, e:
+                failed[id] = e
+        return failed
+
+    def retry(self, queue, id, attempts, message, reason, options):
+        """
+        Put a failed message back at the end of the queue, or drop it once
+        it failed more than max-retries times.
+        """
+        attempts += 1
+        if attempts > options['max-retries']:
+            logger.error('Dropping queued message %r to %s after %d attempts: '
+                         '%s', message.subject, ', '.join(message.recipients()),
+                         attempts, reason)
+            self.settle(queue.ack, id)
+        else:
+            self.settle(queue.nack, id, (attempts, message))
+
+    def settle(self, method, id, *args):
+        """
+        Ack or nack the reservation 'id'. If the visibility timeout passed
+        before the batch was done, the message was handed to another
+        worker under a new id and the old one is unknown; that is logged
+        rather than allowed to stop the worker.
+        """
+        try:
+            method(id, *args)
+        except ValueError, e:
+            logger.warning('Queued message %d outlived its visibility timeout '
+                           'and may be delivered again: %s', id, e)
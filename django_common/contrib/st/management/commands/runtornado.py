@@ -1,17 +1,40 @@
 import os
+import signal
 from optparse import make_option
 
 from django.core.management.base import BaseCommand
 from django.core.wsgi import get_wsgi_application
 from django.conf import settings
 
-import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
 import tornado.web
-import tornado.wsgi
+
+from django_common.contrib.st.metrics import Metrics, MetricsHandler, \
+    MetricsApplication
+from django_common.contrib.st.server import DrainingHTTPServer, \
+    Supervisor, handle_shutdown, inherited_sockets, prewarm, report_ready, \
+    WORKER_ENV
+from django_common.contrib.st.static import StaticFileHandler, LRUCache, \
+    CACHE_SIZE
+from django_common.contrib.st.wsgi import WSGIContainer, \
+    ThreadedWSGIContainer, StreamingWSGIHandler
 
 
 DEFAULT_STATIC_PATH = settings.STATIC_ROOT
+DEFAULT_COMPRESS_RESPONSE = getattr(settings, 'TORNADO_COMPRESS_RESPONSE',
+                                    False)
+DEFAULT_XHEADERS = getattr(settings, 'TORNADO_XHEADERS', False)
+DEFAULT_NO_KEEP_ALIVE = getattr(settings, 'TORNADO_NO_KEEP_ALIVE', False)
+DEFAULT_IDLE_CONNECTION_TIMEOUT = getattr(
+    settings, 'TORNADO_IDLE_CONNECTION_TIMEOUT', None)
+DEFAULT_MAX_BUFFER_SIZE = getattr(settings, 'TORNADO_MAX_BUFFER_SIZE', None)
+DEFAULT_MAX_BODY_SIZE = getattr(settings, 'TORNADO_MAX_BODY_SIZE', None)
+DEFAULT_STREAM_REQUEST_BODY = getattr(settings,
+                                      'TORNADO_STREAM_REQUEST_BODY', False)
+DEFAULT_METRICS = getattr(settings, 'TORNADO_METRICS', False)
+DEFAULT_SHUTDOWN_TIMEOUT = getattr(settings, 'TORNADO_SHUTDOWN_TIMEOUT', 30)
+DEFAULT_PREWARM = getattr(settings, 'TORNADO_PREWARM', True)
 
 
 class Command(BaseCommand):
@@ -37,26 +60,171 @@ class Command(BaseCommand):
             dest='private-key-path',
             default=None,
             help='Location of private key file for SSL/TLS'),
+        make_option('--processes',
+            action='store',
+            dest='processes',
+            type='int',
+            default=1,
+            help='Number of worker processes, 0 for one per CPU'),
+        make_option('--reuse-port',
+            action='store_true',
+            dest='reuse-port',
+            default=False,
+            help='Bind a SO_REUSEPORT socket in every worker process '
+                 'instead of sharing one'),
+        make_option('--max-restarts',
+            action='store',
+            dest='max-restarts',
+            type='int',
+            default=100,
+            help='Times crashed worker processes are restarted before '
+                 'giving up'),
+        make_option('--threads',
+            action='store',
+            dest='threads',
+            type='int',
+            default=0,
+            help='Run Django on a pool of this many threads per process '
+                 'instead of on the IOLoop'),
+        make_option('--static-cache-size',
+            action='store',
+            dest='static-cache-size',
+            type='int',
+            default=CACHE_SIZE,
+            help='Bytes of small static files kept in memory per process'),
+        make_option('--compress-response',
+            action='store_true',
+            dest='compress-response',
+            default=DEFAULT_COMPRESS_RESPONSE,
+            help='Gzip responses for clients that accept it'),
+        make_option('--xheaders',
+            action='store_true',
+            dest='xheaders',
+            default=DEFAULT_XHEADERS,
+            help='Take the remote IP and scheme from X-Real-Ip/'
+                 'X-Forwarded-For and X-Scheme/X-Forwarded-Proto headers'),
+        make_option('--no-keep-alive',
+            action='store_true',
+            dest='no-keep-alive',
+            default=DEFAULT_NO_KEEP_ALIVE,
+            help='Close connections after every request'),
+        make_option('--idle-connection-timeout',
+            action='store',
+            dest='idle-connection-timeout',
+            type='float',
+            default=DEFAULT_IDLE_CONNECTION_TIMEOUT,
+            help='Seconds before idle keep-alive connections are closed'),
+        make_option('--max-buffer-size',
+            action='store',
+            dest='max-buffer-size',
+            type='int',
+            default=DEFAULT_MAX_BUFFER_SIZE,
+            help='Bytes of a request buffered in memory'),
+        make_option('--max-body-size',
+            action='store',
+            dest='max-body-size',
+            type='int',
+            default=DEFAULT_MAX_BODY_SIZE,
+            help='Largest request body accepted in bytes'),
+        make_option('--stream-request-body',
+            action='store_true',
+            dest='stream-request-body',
+            default=DEFAULT_STREAM_REQUEST_BODY,
+            help='Spool request bodies to a temporary file as they arrive '
+                 'instead of buffering them in memory'),
+        make_option('--metrics',
+            action='store_true',
+            dest='metrics',
+            default=DEFAULT_METRICS,
+            help='Record request timings and serve them in the Prometheus '
+                 'text format on /__metrics to local clients'),
+        make_option('--shutdown-timeout',
+            action='store',
+            dest='shutdown-timeout',
+            type='float',
+            default=DEFAULT_SHUTDOWN_TIMEOUT,
+            help='Seconds to finish running requests for on SIGTERM'),
+        make_option('--no-prewarm',
+            action='store_false',
+            dest='prewarm',
+            default=DEFAULT_PREWARM,
+            help='Don\'t load the URLconf, views and templates before '
+                 'accepting connections'),
     )
     help = 'Start tornado server'
 
     def handle(self, *args, **options):
         os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
-        container = tornado.wsgi.WSGIContainer(get_wsgi_application())
+        port = int(options['port'])
+        worker = os.environ.get(WORKER_ENV)
+        # Sockets are bound before starting the workers so they share them,
+        # unless every worker binds its own with SO_REUSEPORT. Workers get
+        # them from the Supervisor, which holds them across reloads.
+        if worker is not None:
+            # SIGHUP is meant for the Supervisor. Workers also get it when
+            # the terminal of their process group hangs up.
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            sockets = inherited_sockets()
+        elif options['reuse-port']:
+            sockets = None
+        else:
+            sockets = tornado.netutil.bind_sockets(port)
+        if worker is None and options['processes'] != 1:
+            Supervisor(sockets or [], options['processes'],
+                       options['max-restarts'],
+                       options['shutdown-timeout']).run()
+            return
+        if sockets is None:
+            sockets = tornado.netutil.bind_sockets(port, reuse_port=True)
+        metrics = Metrics(int(worker or 0)) if options['metrics'] else None
+        if options['threads']:
+            container = ThreadedWSGIContainer(
+                get_wsgi_application(), options['threads'],
+                compress_response=options['compress-response'],
+                metrics=metrics)
+        else:
+            container = WSGIContainer(
+                get_wsgi_application(),
+                compress_response=options['compress-response'],
+                metrics=metrics)
+        StaticFileHandler.cache = LRUCache(options['static-cache-size'])
         handlers = [
-            ('/(robots\.txt)', tornado.web.StaticFileHandler, {'path': options['static-path'] + '/robots.txt'}),
-            ('/static/(.*)', tornado.web.StaticFileHandler, {'path': options['static-path']}),
-            ('.*', tornado.web.FallbackHandler, dict(fallback=container))
+            ('/(robots\.txt)', StaticFileHandler, {'path': options['static-path']}),
+            ('/static/(.*)', StaticFileHandler, {'path': options['static-path']}),
         ]
-        application = tornado.web.Application(handlers, **{
-            'debug': settings.DEBUG
+        if metrics is not None:
+            metrics.monitor_loop()
+            handlers.append(('/__metrics', MetricsHandler,
+                             dict(metrics=metrics, container=container)))
+        if options['stream-request-body']:
+            handlers.append(('.*', StreamingWSGIHandler,
+                             dict(fallback=container)))
+        else:
+            handlers.append(('.*', tornado.web.FallbackHandler,
+                             dict(fallback=container)))
+        application = MetricsApplication(handlers, metrics=metrics, **{
+            'debug': settings.DEBUG,
+            # Autoreload restarts single processes only.
+            'autoreload': settings.DEBUG and options['processes'] == 1,
+            'compress_response': options['compress-response']
         })
-        kwargs = {}
+        kwargs = {
+            'xheaders': options['xheaders'],
+            'no_keep_alive': options['no-keep-alive']
+        }
+        for option in ('idle-connection-timeout', 'max-buffer-size',
+                       'max-body-size'):
+            if options[option] is not None:
+                kwargs[option.replace('-', '_')] = options[option]
         if options['certificate-path'] and options['private-key-path']:
             kwargs['ssl_options'] = {
                 'certfile': options['certificate-path'],
                 'keyfile': options['private-key-path']
             }
-        server = tornado.httpserver.HTTPServer(application, **kwargs)
-        server.listen(options['port'])
-        tornado.ioloop.IOLoop.instance().start()
+        if options['prewarm']:
+            prewarm()
+        server = DrainingHTTPServer(application, **kwargs)
+        server.add_sockets(sockets)
+        handle_shutdown(server, options['shutdown-timeout'])
+        report_ready()
+        tornado.ioloop.IOLoop.current().start()
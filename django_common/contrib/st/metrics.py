@@ -0,0 +1,171 @@
+import bisect
+
+import tornado.ioloop
+import tornado.web
+
+
+# Upper bounds in seconds of the request duration histogram buckets.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Upper bounds in seconds of the IOLoop lag histogram buckets.
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+
+# Seconds between IOLoop lag measurements.
+LAG_INTERVAL = 0.5
+
+# Clients allowed to read the metrics endpoint.
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+
+class Histogram(object):
+    """
+    Counts observations into cumulative buckets with the given upper
+    bounds, like a Prometheus histogram.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        """Yield the sample lines of this histogram."""
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield '%s_bucket{%s} %d' % (name, _labels(labels, le=bound),
+                                        cumulative)
+        yield '%s_sum{%s} %r' % (name, _labels(labels), self.sum)
+        yield '%s_count{%s} %d' % (name, _labels(labels), self.count)
+
+
+def _labels(labels, **extra):
+    items = sorted(labels.items()) + sorted(extra.items())
+    return ','.join('%s="%s"' % item for item in items)
+
+
+class Metrics(object):
+    """
+    Request durations and response counts by handler, Django requests in
+    flight and IOLoop lag for one server process, labelled with its
+    'worker' number. Only touched from the IOLoop thread, so nothing is
+    locked.
+    """
+
+    def __init__(self, worker=0):
+        self.worker = worker
+        self.durations = {}
+        self.responses = {}
+        self.in_flight = 0
+        self.loop_lag = Histogram(LAG_BUCKETS)
+        self.last_loop_lag = 0.0
+
+    def observe(self, handler, status_code, duration):
+        histogram = self.durations.get(handler)
+        if histogram is None:
+            histogram = self.durations[handler] = Histogram(DURATION_BUCKETS)
+        histogram.observe(duration)
+        key = (handler, status_code)
+        self.responses[key] = self.responses.get(key, 0) + 1
+
+    def monitor_loop(self, io_loop=None, interval=LAG_INTERVAL):
+        """
+        Measure how late 'io_loop' runs a callback scheduled every
+        'interval' seconds.
+        """
+        io_loop = io_loop or tornado.ioloop.IOLoop.current()
+
+        def check(deadline):
+            self.last_loop_lag = max(io_loop.time() - deadline, 0.0)
+            self.loop_lag.observe(self.last_loop_lag)
+            schedule()
+
+        def schedule():
+            deadline = io_loop.time() + interval
+            io_loop.call_at(deadline, check, deadline)
+        schedule()
+
+    def render(self, container=None):
+        """
+        Return the metrics in the Prometheus text format, with the thread
+        pool of 'container' if it has one.
+        """
+        worker = {'worker': str(self.worker)}
+        lines = ['# HELP tornado_request_duration_seconds Time taken to '
+                 'handle requests.',
+                 '# TYPE tornado_request_duration_seconds histogram']
+        for handler, histogram in sorted(self.durations.items()):
+            lines.extend(histogram.samples(
+                'tornado_request_duration_seconds',
+                dict(worker, handler=handler)))
+        lines.extend(['# HELP tornado_responses_total Responses sent.',
+                      '# TYPE tornado_responses_total counter'])
+        for (handler, code), count in sorted(self.responses.items()):
+            lines.append('tornado_responses_total{%s} %d' % (
+                _labels(worker, handler=handler, code=code), count))
+        lines.extend(['# HELP tornado_wsgi_requests_in_flight Django '
+                      'requests received and not yet answered.',
+                      '# TYPE tornado_wsgi_requests_in_flight gauge',
+                      'tornado_wsgi_requests_in_flight{%s} %d' % (
+                          _labels(worker), self.in_flight)])
+        lines.extend(['# HELP tornado_ioloop_lag_seconds How late the '
+                      'IOLoop runs scheduled callbacks.',
+                      '# TYPE tornado_ioloop_lag_seconds histogram'])
+        lines.extend(self.loop_lag.samples('tornado_ioloop_lag_seconds',
+                                           worker))
+        if hasattr(container, 'queue_depth'):
+            lines.extend(['# HELP tornado_wsgi_queue_depth Django requests '
+                          'waiting for a thread.',
+                          '# TYPE tornado_wsgi_queue_depth gauge',
+                          'tornado_wsgi_queue_depth{%s} %d' % (
+                              _labels(worker), container.queue_depth()),
+                          '# HELP tornado_wsgi_threads Threads running '
+                          'Django.',
+                          '# TYPE tornado_wsgi_threads gauge',
+                          'tornado_wsgi_threads{%s} %d' % (
+                              _labels(worker), container.max_workers)])
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    Serves Metrics.render() to local clients. The address the connection
+    comes from is checked rather than remote_ip, which clients can set
+    with the X-Real-Ip header when the server trusts xheaders.
+    """
+
+    def initialize(self, metrics, container=None):
+        self.metrics = metrics
+        self.container = container
+
+    def get(self):
+        address = getattr(self.request.connection.context, 'address', None)
+        if not isinstance(address, tuple) or \
+           address[0] not in LOCAL_ADDRESSES:
+            raise tornado.web.HTTPError(403)
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(self.metrics.render(self.container))
+
+
+class MetricsApplication(tornado.web.Application):
+    """
+    An Application that records the duration and status of every request
+    its handlers finish in 'metrics'.
+    """
+
+    def __init__(self, handlers=None, metrics=None, **settings):
+        super(MetricsApplication, self).__init__(handlers, **settings)
+        self.metrics = metrics
+
+    def log_request(self, handler):
+        super(MetricsApplication, self).log_request(handler)
+        if self.metrics is not None:
+            self.metrics.observe(handler.__class__.__name__,
+                                 handler.get_status(),
+                                 handler.request.request_time())
@@ -0,0 +1,391 @@
+import datetime
+import errno
+import fcntl
+import logging
+import os
+import select
+import signal
+import socket
+import sys
+import time
+
+import tornado.gen
+import tornado.httpserver
+import tornado.httputil
+import tornado.ioloop
+import tornado.process
+from tornado.concurrent import Future
+
+
+# Environment variables a Supervisor hands its workers their task id, the
+# listening sockets ('fd:family,...') and the pipe to report ready on with.
+WORKER_ENV = 'RUNTORNADO_WORKER'
+SOCKETS_ENV = 'RUNTORNADO_SOCKETS'
+READY_ENV = 'RUNTORNADO_READY_FD'
+
+# Seconds a new worker may take to get ready before a reload gives up.
+START_TIMEOUT = 120
+
+logger = logging.getLogger(__name__)
+
+
+class _TrackedConnection(object):
+    """
+    Wraps the HTTP1Connection of one request to tell the server when the
+    response is finished, and to close the connection after the response
+    once the server is draining.
+    """
+
+    def __init__(self, server, connection):
+        self.server = server
+        self.connection = connection
+        self.active = False
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def started(self):
+        if not self.active:
+            self.active = True
+            self.server.active += 1
+
+    def done(self):
+        if self.active:
+            self.active = False
+            self.server._request_done()
+
+    def _close_if_draining(self):
+        if self.server.draining:
+            # Tornado decides whether to keep the connection open from this
+            # flag alone, and tells HTTP/1.1 clients with "Connection: close".
+            self.connection._disconnect_on_finish = True
+
+    def write_headers(self, start_line, headers, *args, **kwargs):
+        self._close_if_draining()
+        return self.connection.write_headers(start_line, headers, *args,
+                                             **kwargs)
+
+    def finish(self):
+        self._close_if_draining()
+        self.connection.finish()
+        self.done()
+
+
+class _TrackedDelegate(tornado.httputil.HTTPMessageDelegate):
+
+    def __init__(self, connection, delegate):
+        self.connection = connection
+        self.delegate = delegate
+
+    def headers_received(self, start_line, headers):
+        self.connection.started()
+        return self.delegate.headers_received(start_line, headers)
+
+    def data_received(self, chunk):
+        return self.delegate.data_received(chunk)
+
+    def finish(self):
+        return self.delegate.finish()
+
+    def on_connection_close(self):
+        self.connection.done()
+        return self.delegate.on_connection_close()
+
+
+class DrainingHTTPServer(tornado.httpserver.HTTPServer):
+    """
+    An HTTPServer that counts the requests it is handling, so drain() can
+    stop accepting connections and wait for them to be answered.
+    """
+
+    def initialize(self, *args, **kwargs):
+        super(DrainingHTTPServer, self).initialize(*args, **kwargs)
+        self.active = 0
+        self.draining = False
+        self._drained = None
+
+    def start_request(self, server_conn, request_conn):
+        connection = _TrackedConnection(self, request_conn)
+        delegate = super(DrainingHTTPServer, self).start_request(server_conn,
+                                                                 connection)
+        return _TrackedDelegate(connection, delegate)
+
+    def _request_done(self):
+        self.active -= 1
+        if not self.active and self._drained is not None and \
+           not self._drained.done():
+            self._drained.set_result(None)
+
+    @tornado.gen.coroutine
+    def drain(self, timeout):
+        """
+        Stop accepting connections and wait up to 'timeout' seconds for the
+        requests being handled, leaving self.active at the number still
+        unanswered. Responses sent meanwhile close their connection.
+        """
+        self.stop()
+        self.draining = True
+        if self.active:
+            self._drained = Future()
+            try:
+                yield tornado.gen.with_timeout(
+                    datetime.timedelta(seconds=timeout), self._drained)
+            except tornado.gen.TimeoutError:
+                pass
+
+
+def handle_shutdown(server, timeout, io_loop=None):
+    """
+    Drain 'server' for up to 'timeout' seconds and stop 'io_loop' on
+    SIGTERM or SIGINT. The process exits at once if requests are still
+    running then, as threads running Django would otherwise hold it up.
+    """
+    io_loop = io_loop or tornado.ioloop.IOLoop.current()
+    state = {'stopping': False}
+
+    @tornado.gen.coroutine
+    def shutdown():
+        if state['stopping']:
+            return
+        state['stopping'] = True
+        logger.info('Draining %d requests', server.active)
+        yield server.drain(timeout)
+        if server.active:
+            logger.warning('Exiting with %d requests unanswered after %s '
+                           'seconds', server.active, timeout)
+            logging.shutdown()
+            os._exit(1)
+        io_loop.stop()
+
+    def handler(signum, frame):
+        io_loop.add_callback_from_signal(shutdown)
+    signal.signal(signal.SIGTERM, handler)
+    signal.signal(signal.SIGINT, handler)
+
+
+def prewarm():
+    """
+    Import the URLconf and every view it names, and load every template
+    of the configured template engines (compiled templates are kept when
+    the cached loader is used), so a new worker doesn't do it on its first
+    requests.
+    """
+    from django.core.urlresolvers import get_resolver
+
+    def load_views(patterns):
+        for pattern in patterns:
+            if hasattr(pattern, 'url_patterns'):
+                load_views(pattern.url_patterns)
+            else:
+                pattern.callback
+    load_views(get_resolver(None).url_patterns)
+    try:
+        from django.template import engines
+    except ImportError:
+        return
+    for engine in engines.all():
+        for directory in engine.template_dirs:
+            for root, dirs, files in os.walk(directory):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        engine.get_template(os.path.relpath(path, directory))
+                    except Exception:
+                        pass
+
+
+def inherited_sockets():
+    """
+    Return the listening sockets passed down by a Supervisor, or None if
+    this process wasn't started by one with shared sockets.
+    """
+    value = os.environ.get(SOCKETS_ENV)
+    if not value:
+        return None
+    sockets = []
+    for item in value.split(','):
+        fd, family = [int(part) for part in item.split(':')]
+        sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
+        os.close(fd)
+        sock.setblocking(0)
+        sockets.append(sock)
+    return sockets
+
+
+def report_ready():
+    """Tell the Supervisor that started this process that it is serving."""
+    fd = os.environ.get(READY_ENV)
+    if fd is None:
+        return
+    try:
+        os.write(int(fd), '1')
+        os.close(int(fd))
+    except OSError:
+        pass
+
+
+def _set_inheritable(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+
+
+class Supervisor(object):
+    """
+    Runs 'processes' (0 for one per CPU) copies of the current command as
+    worker processes that serve 'sockets', or bind their own with
+    SO_REUSEPORT if 'sockets' is empty. Workers are started by re-executing
+    the command, so they load the code currently on disk. Crashed workers
+    are restarted, up to 'max_restarts' times.
+
+    SIGHUP replaces the workers one at a time: a new worker is started and
+    only once it is serving is the old one sent SIGTERM, so the sockets
+    are never closed. SIGTERM and SIGINT stop all workers, which finish
+    their requests for up to 'shutdown_timeout' seconds.
+    """
+
+    def __init__(self, sockets, processes, max_restarts, shutdown_timeout):
+        self.sockets = sockets
+        self.processes = processes or tornado.process.cpu_count()
+        self.max_restarts = max_restarts
+        self.shutdown_timeout = shutdown_timeout
+        self.workers = {}
+        self.restarts = 0
+        self.stopping = False
+        # Set by the signal handler. A stop is never undone by a later
+        # SIGHUP.
+        self.reload_requested = False
+        self.stop_requested = False
+
+    def _signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.reload_requested = True
+        else:
+            self.stop_requested = True
+
+    def _spawn(self, task_id, wait=False):
+        """
+        Start worker 'task_id'. With 'wait', returns whether it got ready
+        within START_TIMEOUT seconds.
+        """
+        read_fd, write_fd = os.pipe()
+        env = dict(os.environ)
+        env[WORKER_ENV] = str(task_id)
+        env[READY_ENV] = str(write_fd)
+        if self.sockets:
+            env[SOCKETS_ENV] = ','.join('%d:%d' % (sock.fileno(), sock.family)
+                                        for sock in self.sockets)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read_fd)
+                _set_inheritable(write_fd)
+                for sock in self.sockets:
+                    _set_inheritable(sock.fileno())
+                os.execve(sys.executable, [sys.executable] + sys.argv, env)
+            finally:
+                os._exit(127)
+        os.close(write_fd)
+        self.workers[pid] = task_id
+        logger.info('Started worker %d (pid %d)', task_id, pid)
+        if not wait:
+            os.close(read_fd)
+            return pid, True
+        return pid, self._wait_ready(read_fd)
+
+    def _wait_ready(self, read_fd):
+        deadline = time.time() + START_TIMEOUT
+        try:
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                try:
+                    if select.select([read_fd], [], [], remaining)[0]:
+                        return os.read(read_fd, 1) == '1'
+                except (OSError, select.error), e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+        finally:
+            os.close(read_fd)
+
+    def _wait_exit(self, pid, timeout):
+        """Wait up to 'timeout' seconds for 'pid' to exit, then kill it."""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0]:
+                    return
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    return
+                if e.errno != errno.EINTR:
+                    raise
+            time.sleep(0.1)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+    def _reload(self):
+        logger.info('Reloading %d workers', len(self.workers))
+        for pid, task_id in sorted(self.workers.items()):
+            if self.stopping or self.stop_requested:
+                return
+            new_pid, ready = self._spawn(task_id, wait=True)
+            if not ready:
+                logger.error('Worker %d did not start, keeping the running '
+                             'workers', task_id)
+                del self.workers[new_pid]
+                os.kill(new_pid, signal.SIGKILL)
+                self._wait_exit(new_pid, 0)
+                return
+            del self.workers[pid]
+            os.kill(pid, signal.SIGTERM)
+            self._wait_exit(pid, self.shutdown_timeout + 5)
+
+    def _stop(self):
+        logger.info('Stopping %d workers', len(self.workers))
+        self.stopping = True
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def _reap(self, pid, status):
+        task_id = self.workers.pop(pid, None)
+        if task_id is None or self.stopping:
+            return
+        if os.WIFSIGNALED(status):
+            logger.warning('Worker %d (pid %d) killed by signal %d, '
+                           'restarting', task_id, pid, os.WTERMSIG(status))
+        elif os.WEXITSTATUS(status) != 0:
+            logger.warning('Worker %d (pid %d) exited with status %d, '
+                           'restarting', task_id, pid, os.WEXITSTATUS(status))
+        else:
+            logger.info('Worker %d (pid %d) exited', task_id, pid)
+            return
+        self.restarts += 1
+        if self.restarts > self.max_restarts:
+            self._stop()
+            raise RuntimeError('Too many worker restarts, giving up')
+        self._spawn(task_id)
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self._signal)
+        signal.signal(signal.SIGTERM, self._signal)
+        signal.signal(signal.SIGINT, self._signal)
+        for task_id in range(self.processes):
+            self._spawn(task_id)
+        while self.workers:
+            if self.stop_requested and not self.stopping:
+                self._stop()
+            reload, self.reload_requested = self.reload_requested, False
+            if reload and not self.stopping:
+                self._reload()
+                continue
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            self._reap(pid, status)
@@ -0,0 +1,168 @@
+import mimetypes
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import tornado.web
+
+
+# Bytes of small static files kept in memory per process.
+CACHE_SIZE = 16 << 20
+
+# Largest file kept in memory, bigger files are streamed from disk.
+CACHE_MAX_FILE_SIZE = 256 << 10
+
+# Precompressed siblings looked for next to a requested file, in order
+# of preference.
+PRECOMPRESSED = (('br', '.br'), ('gzip', '.gz'))
+
+# Names with a content hash, as written by Django's CachedStaticFilesStorage
+# and ManifestStaticFilesStorage (e.g. 'css/base.5af66c1b1797.css').
+HASHED_NAME = re.compile(r'\.([0-9a-f]{12})\.[^/]+$')
+
+
+class LRUCache(object):
+    """
+    Keeps the contents of up to 'max_bytes' bytes of files, dropping the
+    least recently used ones first. Entries are checked against the
+    file's modification time and size.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path, stat):
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is None:
+                return None
+            if entry[0] != (stat.st_mtime, stat.st_size):
+                self.size -= len(entry[1])
+                return None
+            self.entries[path] = entry
+            return entry[1]
+
+    def put(self, path, stat, data):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                self.size -= len(entry[1])
+            self.entries[path] = ((stat.st_mtime, stat.st_size), data)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                oldest = self.entries.popitem(last=False)[1]
+                self.size -= len(oldest[1])
+
+
+def _accepted_encodings(header):
+    """
+    Return the content codings accepted by an Accept-Encoding header,
+    leaving out those with a quality of 0.
+    """
+    encodings = set()
+    for item in header.split(','):
+        params = [param.strip() for param in item.split(';')]
+        if not params[0]:
+            continue
+        rejected = False
+        for param in params[1:]:
+            if param.startswith('q='):
+                try:
+                    rejected = float(param[2:]) == 0
+                except ValueError:
+                    pass
+        if not rejected:
+            encodings.add(params[0].lower())
+    return encodings
+
+
+class StaticFileHandler(tornado.web.StaticFileHandler):
+    """
+    A StaticFileHandler for serving STATIC_ROOT without a web server in
+    front:
+
+    - files up to 'cache_max_file_size' bytes are served from an
+      in-memory LRU 'cache' shared by all handlers of the process,
+    - a 'name.br' or 'name.gz' sibling is served instead of 'name' when
+      the client accepts that encoding,
+    - ETags come from the modification time and size, or from the hash
+      in the name for hashed files, instead of from reading the whole
+      file,
+    - hashed files are cached by clients for CACHE_MAX_AGE seconds and
+      marked immutable.
+    """
+
+    cache = LRUCache(CACHE_SIZE)
+    cache_max_file_size = CACHE_MAX_FILE_SIZE
+
+    def validate_absolute_path(self, root, absolute_path):
+        absolute_path = super(StaticFileHandler, self).validate_absolute_path(
+            root, absolute_path)
+        self.original_path = absolute_path
+        self.content_encoding = None
+        if absolute_path is None:
+            return None
+        accepted = _accepted_encodings(
+            self.request.headers.get('Accept-Encoding', ''))
+        for encoding, suffix in PRECOMPRESSED:
+            if encoding in accepted and os.path.isfile(absolute_path + suffix):
+                self.content_encoding = encoding
+                return absolute_path + suffix
+        return absolute_path
+
+    @classmethod
+    def get_content(cls, abspath, start=None, end=None):
+        stat = os.stat(abspath)
+        if stat.st_size > cls.cache_max_file_size:
+            return super(StaticFileHandler, cls).get_content(abspath, start,
+                                                             end)
+        data = cls.cache.get(abspath, stat)
+        if data is None:
+            with open(abspath, 'rb') as file:
+                data = file.read()
+            cls.cache.put(abspath, stat, data)
+        if start is None and end is None:
+            return data
+        return data[start:end]
+
+    def _hash(self):
+        match = HASHED_NAME.search(self.original_path)
+        return match and match.group(1)
+
+    def compute_etag(self):
+        version = self._hash()
+        if not version:
+            stat = self._stat()
+            version = '%x-%x' % (int(stat.st_mtime), stat.st_size)
+        if self.content_encoding:
+            version += '-' + self.content_encoding
+        return '"%s"' % version
+
+    def get_content_type(self):
+        if self.content_encoding is None:
+            return super(StaticFileHandler, self).get_content_type()
+        mime_type, encoding = mimetypes.guess_type(self.original_path)
+        return mime_type or 'application/octet-stream'
+
+    def get_cache_time(self, path, modified, mime_type):
+        if self._hash():
+            return self.CACHE_MAX_AGE
+        return super(StaticFileHandler, self).get_cache_time(path, modified,
+                                                             mime_type)
+
+    def set_extra_headers(self, path):
+        # With compress_response set, tornado's transform adds it already.
+        if tornado.web.GZipContentEncoding not in self.application.transforms:
+            self.set_header('Vary', 'Accept-Encoding')
+        if self.content_encoding:
+            self.set_header('Content-Encoding', self.content_encoding)
+        if self._hash():
+            self.set_header('Cache-Control',
+                            'public, max-age=%d, immutable' %
+                            self.CACHE_MAX_AGE)
@@ -0,0 +1,210 @@
+import copy
+import functools
+import logging
+import tempfile
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import tornado
+import tornado.escape
+import tornado.httputil
+import tornado.ioloop
+import tornado.web
+import tornado.wsgi
+
+
+# Bytes of a streamed request body kept in memory before it is spooled to
+# a temporary file.
+SPOOL_SIZE = 1 << 20
+
+logger = logging.getLogger(__name__)
+
+
+class WSGIContainer(tornado.wsgi.WSGIContainer):
+    """
+    A WSGIContainer that reads the request body from the request's
+    'body_file' if StreamingWSGIHandler spooled it there, and gzips
+    responses with 'compress_response' set. (Tornado's own
+    compress_response setting doesn't apply to WSGI responses, which are
+    written straight to the connection.) Requests are recorded in
+    'metrics', a django_common.contrib.st.metrics.Metrics, if given.
+    """
+
+    def __init__(self, wsgi_application, compress_response=False,
+                 metrics=None):
+        super(WSGIContainer, self).__init__(wsgi_application)
+        self.compress_response = compress_response
+        self.metrics = metrics
+
+    def __call__(self, request):
+        self._started()
+        environ = self.environ(request)
+        try:
+            response = self._call_application(environ)
+        except Exception:
+            response = self._error_response()
+        self._write_response(request, response)
+
+    def _started(self):
+        if self.metrics is not None:
+            self.metrics.in_flight += 1
+
+    def _error_response(self):
+        logger.error('Uncaught exception in WSGI application', exc_info=True)
+        return '500 Internal Server Error', [], ''
+
+    @staticmethod
+    def environ(request):
+        body_file = getattr(request, 'body_file', None)
+        if body_file is not None:
+            # The body of a streamed request is a Future that tornado
+            # still checks, so it is left alone and skipped here.
+            request = copy.copy(request)
+            request.body = ''
+        environ = tornado.wsgi.WSGIContainer.environ(request)
+        if body_file is not None:
+            environ['wsgi.input'] = body_file
+        elif request.body and 'CONTENT_LENGTH' not in environ:
+            # Chunked request bodies have no Content-Length header.
+            environ['CONTENT_LENGTH'] = str(len(request.body))
+        return environ
+
+    def _call_application(self, environ):
+        """
+        Run the WSGI application, returning the status line, headers and
+        body of its response.
+        """
+        data = {}
+        response = []
+
+        def start_response(status, response_headers, exc_info=None):
+            data['status'] = status
+            data['headers'] = response_headers
+            return response.append
+        try:
+            app_response = self.wsgi_application(environ, start_response)
+            try:
+                response.extend(app_response)
+                body = ''.join(response)
+            finally:
+                if hasattr(app_response, 'close'):
+                    app_response.close()
+        finally:
+            environ['wsgi.input'].close()
+        if not data:
+            raise Exception('WSGI app did not call start_response')
+        return data['status'], data['headers'], body
+
+    def _write_response(self, request, response):
+        try:
+            self._send_response(request, response)
+        finally:
+            if self.metrics is not None:
+                self.metrics.in_flight -= 1
+
+    def _send_response(self, request, response):
+        status, headers, body = response
+        status_code, reason = status.split(' ', 1)
+        status_code = int(status_code)
+        header_set = set(k.lower() for (k, v) in headers)
+        body = tornado.escape.utf8(body)
+        if status_code != 304:
+            if 'content-length' not in header_set:
+                headers.append(('Content-Length', str(len(body))))
+            if 'content-type' not in header_set:
+                headers.append(('Content-Type', 'text/html; charset=UTF-8'))
+        if 'server' not in header_set:
+            headers.append(('Server', 'TornadoServer/%s' % tornado.version))
+        start_line = tornado.httputil.ResponseStartLine('HTTP/1.1',
+                                                        status_code, reason)
+        header_obj = tornado.httputil.HTTPHeaders()
+        for key, value in headers:
+            header_obj.add(key, value)
+        if self.compress_response:
+            status_code, header_obj, body = \
+                tornado.web.GZipContentEncoding(request).transform_first_chunk(
+                    status_code, header_obj, body, True)
+        if request.method == 'HEAD' or status_code == 304:
+            # Tornado refuses a body for these, Content-Length or not.
+            body = None
+        request.connection.write_headers(start_line, header_obj, chunk=body)
+        request.connection.finish()
+        self._log(status_code, request)
+        if self.metrics is not None:
+            self.metrics.observe('wsgi', status_code, request.request_time())
+
+
+class ThreadedWSGIContainer(WSGIContainer):
+    """
+    A WSGIContainer that calls the WSGI application on a pool of
+    'max_workers' threads instead of on the IOLoop, so a slow request
+    doesn't hold up every other connection. The response is still written
+    by the IOLoop once the application returns.
+    """
+
+    def __init__(self, wsgi_application, max_workers, **kwargs):
+        super(ThreadedWSGIContainer, self).__init__(wsgi_application,
+                                                    **kwargs)
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.queued = 0
+        self.queued_lock = threading.Lock()
+
+    def __call__(self, request):
+        self._started()
+        environ = self.environ(request)
+        environ['wsgi.multithread'] = True
+        with self.queued_lock:
+            self.queued += 1
+        future = self.executor.submit(self._call_queued_application, environ)
+        tornado.ioloop.IOLoop.current().add_future(
+            future, functools.partial(self._application_done, request))
+
+    def queue_depth(self):
+        """Return the number of requests waiting for a thread."""
+        return self.queued
+
+    def _call_queued_application(self, environ):
+        with self.queued_lock:
+            self.queued -= 1
+        return self._call_application(environ)
+
+    def _application_done(self, request, future):
+        try:
+            response = future.result()
+        except Exception:
+            response = self._error_response()
+        self._write_response(request, response)
+
+
+@tornado.web.stream_request_body
+class StreamingWSGIHandler(tornado.web.RequestHandler):
+    """
+    Hands requests to a WSGIContainer like FallbackHandler, but spools the
+    request body into a temporary file as it arrives instead of buffering
+    it in memory, so uploads up to the server's max_body_size don't need
+    as much memory.
+    """
+
+    def initialize(self, fallback, spool_size=SPOOL_SIZE):
+        self.fallback = fallback
+        self.spool_size = spool_size
+
+    def prepare(self):
+        self.request.body_file = tempfile.SpooledTemporaryFile(
+            self.spool_size)
+
+    def data_received(self, chunk):
+        self.request.body_file.write(chunk)
+
+    def _call_fallback(self, *args):
+        body_file = self.request.body_file
+        if 'Content-Length' not in self.request.headers:
+            self.request.headers['Content-Length'] = str(body_file.tell())
+        body_file.seek(0)
+        self.fallback(self.request)
+        self._finished = True
+        self.on_finish()
+
+    get = head = post = delete = patch = put = options = _call_fallback
@@ -0,0 +1,86 @@
+"""Persistent queue email backend class."""
+
+import copy
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail.backends.base import BaseEmailBackend
+
+from django_common.core.queue.persistent import PersistentQueue, \
+    VISIBILITY_TIMEOUT
+
+# Backend used by the sendqueuedmail command to deliver queued messages.
+DEFAULT_DELIVERY_BACKEND = 'django_common.core.mail.backends.sendmail.EmailBackend'
+
+# Queues opened by this process, keyed by path. PersistentQueue is thread
+# safe, so every backend instance shares one.
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_queue(path=None):
+    """
+    Return this process' handle on the mail queue at 'path'
+    (settings.EMAIL_QUEUE_PATH by default), opening it if needed.
+
+    Items are (attempts, EmailMessage) tuples. The queue is opened in
+    multiprocess mode, so web processes and sendqueuedmail workers can
+    share it, with settings.EMAIL_QUEUE_DURABILITY as durability policy
+    and settings.EMAIL_QUEUE_VISIBILITY_TIMEOUT as visibility timeout.
+    """
+    if path is None:
+        path = getattr(settings, 'EMAIL_QUEUE_PATH', None)
+        if not path:
+            raise ImproperlyConfigured('EMAIL_QUEUE_PATH must be set to use '
+                                       'the queued email backend')
+    with _queues_lock:
+        queue = _queues.get(path)
+        if queue is None:
+            durability = getattr(settings, 'EMAIL_QUEUE_DURABILITY', 'none')
+            visibility_timeout = getattr(settings,
+                                         'EMAIL_QUEUE_VISIBILITY_TIMEOUT',
+                                         VISIBILITY_TIMEOUT)
+            queue = PersistentQueue(path, multiprocess=True,
+                                    serializer='pickle',
+                                    durability=durability,
+                                    visibility_timeout=visibility_timeout)
+            _queues[path] = queue
+        return queue
+
+
+class EmailBackend(BaseEmailBackend):
+    """
+    Spools messages into a PersistentQueue instead of sending them, so
+    callers don't wait on delivery. Run the sendqueuedmail management
+    command (django_common.contrib.mail) to deliver them.
+    """
+
+    def __init__(self, fail_silently=False, path=None, **kwargs):
+        super(EmailBackend, self).__init__(fail_silently=fail_silently)
+        self.path = path
+
+    def send_messages(self, email_messages):
+        """
+        Queues one or more EmailMessage objects and returns the number of
+        email messages queued.
+        """
+        if not email_messages:
+            return
+        items = []
+        for message in email_messages:
+            if not message.recipients():
+                continue
+            # Backends aren't picklable, and the worker uses its own.
+            message = copy.copy(message)
+            message.connection = None
+            items.append((0, message))
+        if not items:
+            return 0
+        try:
+            get_queue(self.path).put_many(items)
+        except:
+            if not self.fail_silently:
+                raise
+            return 0
+        return len(items)
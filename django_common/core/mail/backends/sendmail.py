@@ -1,15 +1,272 @@
 """sendmail email backend class."""
 
+import atexit
+import smtplib
+import sys
 import threading
+from email import generator
 
 from django.conf import settings
 from django.core.mail.backends.base import BaseEmailBackend
+from django.core.mail.utils import DNS_NAME
 from subprocess import Popen,PIPE
 
+# Long-lived 'sendmail -bs' sessions shared by every backend instance in
+# the process, keyed by command. Only one message is sent through a
+# session at a time.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# Bytes of SMTP DATA buffered before they are written to a session.
+DATA_CHUNK_SIZE = 1 << 16
+
+
+class _StreamingGenerator(generator.Generator):
+    """
+    A Generator that writes multipart messages straight to its file, part
+    by part, instead of rendering every part into a string first. Multipart
+    boundaries are picked up front, so they aren't checked against the
+    rendered parts.
+    """
+
+    def _write(self, msg):
+        if msg.get_content_maintype() != 'multipart' or \
+           not msg.is_multipart():
+            return generator.Generator._write(self, msg)
+        if not msg.get_boundary():
+            msg.set_boundary(generator._make_boundary())
+        meth = getattr(msg, '_write_headers', None)
+        if meth is None:
+            self._write_headers(msg)
+        else:
+            meth(self)
+        self._dispatch(msg)
+
+    def _handle_multipart(self, msg):
+        subparts = msg.get_payload()
+        if subparts is None:
+            subparts = []
+        elif isinstance(subparts, basestring):
+            self._fp.write(subparts)
+            return
+        elif not isinstance(subparts, list):
+            subparts = [subparts]
+        boundary = msg.get_boundary()
+        if msg.preamble is not None:
+            if self._mangle_from_:
+                print >> self._fp, generator.fcre.sub('>From ', msg.preamble)
+            else:
+                print >> self._fp, msg.preamble
+        print >> self._fp, '--' + boundary
+        for i, part in enumerate(subparts):
+            if i:
+                print >> self._fp, '\n--' + boundary
+            self.clone(self._fp).flatten(part, unixfrom=False)
+        self._fp.write('\n--' + boundary + '--' + generator.NL)
+        if msg.epilogue is not None:
+            if self._mangle_from_:
+                self._fp.write(generator.fcre.sub('>From ', msg.epilogue))
+            else:
+                self._fp.write(msg.epilogue)
+
+
+class _DataWriter(object):
+    """
+    File-like object that turns the lines written to it into SMTP DATA
+    (CRLF line endings, leading dots doubled) and sends them to 'sock' in
+    chunks of DATA_CHUNK_SIZE bytes.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.line = ''
+        self.chunk = []
+        self.size = 0
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        lines = (self.line + data).split('\n')
+        self.line = lines.pop()
+        for line in lines:
+            self._add(line)
+
+    def _add(self, line):
+        if line.endswith('\r'):
+            line = line[:-1]
+        if line.startswith('.'):
+            line = '.' + line
+        self.chunk.append(line + '\r\n')
+        self.size += len(line) + 2
+        if self.size >= DATA_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.chunk:
+            self.sock.sendall(''.join(self.chunk))
+            self.chunk = []
+            self.size = 0
+
+    def close(self):
+        """Send the last line and the end of data marker."""
+        if self.line:
+            self._add(self.line)
+            self.line = ''
+        self.chunk.append('.\r\n')
+        self.flush()
+
+
+class _PipeSocket(object):
+    """
+    The part of the socket interface smtplib uses, on top of the stdin
+    and stdout of a child process.
+    """
+
+    def __init__(self, process):
+        self.process = process
+
+    def sendall(self, data):
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+    def makefile(self, mode='rb', bufsize=-1):
+        return self.process.stdout
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.process.wait()
+
+
+class SendmailSMTP(smtplib.SMTP):
+    """
+    An SMTP session with 'sendmail -bs', which speaks SMTP on its
+    standard input and output.
+    """
+
+    def __init__(self, command):
+        self.command = command
+        smtplib.SMTP.__init__(self, local_hostname=DNS_NAME.get_fqdn())
+
+    def connect(self, host=None, port=None):
+        process = Popen(list(self.command) + ['-bs'], stdin=PIPE,
+                        stdout=PIPE)
+        self.sock = _PipeSocket(process)
+        self.file = None
+        code, msg = self.getreply()
+        if code != 220:
+            self.close()
+            raise smtplib.SMTPConnectError(code, msg)
+        return code, msg
+
+    def stream_message(self, from_addr, to_addrs, message):
+        """
+        Like sendmail(), but writes the email.Message 'message' into the
+        DATA command as it is generated instead of taking a string.
+        """
+        self.ehlo_or_helo_if_needed()
+        code, resp = self.mail(from_addr)
+        if code != 250:
+            self.rset()
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+        refused = {}
+        for each in to_addrs:
+            code, resp = self.rcpt(each)
+            if code not in (250, 251):
+                refused[each] = (code, resp)
+        if len(refused) == len(to_addrs):
+            self.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+        self.putcmd('data')
+        code, resp = self.getreply()
+        if code != 354:
+            raise smtplib.SMTPDataError(code, resp)
+        writer = _DataWriter(self.sock)
+        _StreamingGenerator(writer, mangle_from_=False).flatten(message)
+        writer.close()
+        code, resp = self.getreply()
+        if code != 250:
+            self.rset()
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+
+def _close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            try:
+                session.quit()
+            except (smtplib.SMTPException, IOError, OSError):
+                session.close()
+        _sessions.clear()
+
+atexit.register(_close_sessions)
+
+
 class EmailBackend(BaseEmailBackend):
+    """
+    Sends messages by piping them to sendmail.
+
+    By default every message starts a new sendmail process. With
+    'persistent' (or settings.EMAIL_SENDMAIL_PERSISTENT) set, messages
+    are streamed through one long-lived 'sendmail -bs' SMTP session per
+    process instead, which is kept open across send_messages() calls and
+    open()/close() cycles, and quit when the process exits.
+
+    Otherwise up to 'concurrency' (settings.EMAIL_SENDMAIL_CONCURRENCY,
+    default 1) sendmail processes run at once.
+
+    With 'max_recipients' (settings.EMAIL_SENDMAIL_MAX_RECIPIENTS) set,
+    messages in one send_messages() call that differ only by their Bcc
+    recipients are rendered once and handed to sendmail together, up to
+    that many recipients per delivery, and messages with more recipients
+    are handed over in several deliveries. Messages with different To or Cc
+    lists are never merged, as those are part of the rendered headers,
+    and shared To or Cc recipients get a single copy of a merged message.
+
+    After send_messages() 'results' holds the outcome of every message of
+    the call: True once it was sent, False or the exception if it failed,
+    None if it was not tried because an earlier delivery raised.
+    """
+
+    def __init__(self, fail_silently=False, persistent=None, command=None,
+                 concurrency=None, max_recipients=None, **kwargs):
+        super(EmailBackend, self).__init__(fail_silently=fail_silently)
+        if persistent is None:
+            persistent = getattr(settings, 'EMAIL_SENDMAIL_PERSISTENT', False)
+        if command is None:
+            command = getattr(settings, 'EMAIL_SENDMAIL_COMMAND', 'sendmail')
+        if concurrency is None:
+            concurrency = getattr(settings, 'EMAIL_SENDMAIL_CONCURRENCY', 1)
+        if max_recipients is None:
+            max_recipients = getattr(settings, 'EMAIL_SENDMAIL_MAX_RECIPIENTS',
+                                     None)
+        assert concurrency > 0, 'Concurrency must be larger than 0'
+        assert not max_recipients or max_recipients > 0, \
+               'Max recipients must be larger than 0'
+        self.persistent = persistent
+        self.concurrency = concurrency
+        self.max_recipients = max_recipients
+        self.command = (command,) if isinstance(command, basestring) \
+                       else tuple(command)
+        self.results = []
+        self._results_lock = threading.Lock()
 
     def open(self):
-        return True
+        if not self.persistent:
+            return True
+        with _sessions_lock:
+            if self.command in _sessions:
+                return False
+            try:
+                self._session()
+            except:
+                if not self.fail_silently:
+                    raise
+                return None
+            return True
 
     def close(self):
         pass
@@ -21,26 +278,188 @@ class EmailBackend(BaseEmailBackend):
         """
         if not email_messages:
             return
-        num_sent = 0
-        for message in email_messages:
-            sent = self._send(message)
-            if sent:
-                num_sent += 1
-        return num_sent
-
-    def _send(self, email_message):
+        self.results = [None] * len(email_messages)
+        if self.max_recipients:
+            deliveries = self._batch(email_messages)
+        else:
+            deliveries = [(message, message.recipients(), [index])
+                          for index, message in enumerate(email_messages)]
+        self._remaining = [0] * len(email_messages)
+        for message, recipients, indexes in deliveries:
+            for index in indexes:
+                self._remaining[index] += 1
+        if self.concurrency > 1 and not self.persistent and \
+           len(deliveries) > 1:
+            self._send_parallel(deliveries)
+        else:
+            for delivery in deliveries:
+                self._deliver(*delivery)
+        return self.results.count(True)
+
+    def _deliver(self, message, recipients, indexes):
+        """
+        Send one delivery and record its outcome for the messages at
+        'indexes'. A message counts as sent once all of its deliveries
+        were.
+        """
+        sent = None
+        try:
+            sent = self._send(message, recipients)
+        except Exception, e:
+            sent = e
+            raise
+        finally:
+            with self._results_lock:
+                for index in indexes:
+                    if sent is True:
+                        self._remaining[index] -= 1
+                        if not self._remaining[index] and \
+                           self.results[index] is None:
+                            self.results[index] = True
+                    elif sent is not None:
+                        self.results[index] = sent
+
+    def _batch_key(self, email_message):
+        """
+        Everything that goes into the rendered message apart from Bcc, or
+        None if the message can't be compared cheaply.
+        """
+        key = (email_message.__class__, email_message.from_email,
+               tuple(email_message.to), tuple(email_message.cc),
+               tuple(getattr(email_message, 'reply_to', ())),
+               email_message.subject, email_message.body,
+               email_message.content_subtype, email_message.mixed_subtype,
+               getattr(email_message, 'alternative_subtype', None),
+               email_message.encoding,
+               tuple(sorted(email_message.extra_headers.items())),
+               tuple(email_message.attachments),
+               tuple(getattr(email_message, 'alternatives', ())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _batch(self, email_messages):
+        """
+        Group 'email_messages' into (message, recipients, indexes)
+        deliveries of at most max_recipients recipients, where 'message'
+        is rendered for the messages at 'indexes' of 'email_messages'. A
+        message with more recipients than that is sent in several
+        deliveries of its own.
+        """
+        deliveries = []
+        pending = {}
+        for index, message in enumerate(email_messages):
+            recipients = message.recipients()
+            if len(recipients) > self.max_recipients:
+                for start in xrange(0, len(recipients), self.max_recipients):
+                    deliveries.append(
+                        [message,
+                         recipients[start:start + self.max_recipients],
+                         [index]])
+                continue
+            key = self._batch_key(message)
+            if key is None:
+                deliveries.append((message, recipients, [index]))
+                continue
+            delivery = pending.get(key)
+            if delivery is not None:
+                new = [recipient for recipient in recipients
+                       if recipient not in delivery[1]]
+            if delivery is not None and \
+               len(delivery[1]) + len(new) <= self.max_recipients:
+                delivery[1].extend(new)
+                delivery[2].append(index)
+            else:
+                delivery = [message, list(recipients), [index]]
+                pending[key] = delivery
+                deliveries.append(delivery)
+        return [tuple(delivery) for delivery in deliveries]
+
+    def _send_parallel(self, deliveries):
+        """
+        Send 'deliveries' from up to 'concurrency' threads, each waiting
+        on one sendmail process at a time. The first error stops the
+        remaining sends and is raised once all threads are done.
+        """
+        deliveries_iter = iter(deliveries)
+        lock = threading.Lock()
+        state = {'error': None}
+
+        def worker():
+            while True:
+                with lock:
+                    if state['error'] is not None:
+                        return
+                    try:
+                        delivery = next(deliveries_iter)
+                    except StopIteration:
+                        return
+                try:
+                    self._deliver(*delivery)
+                except:
+                    with lock:
+                        if state['error'] is None:
+                            state['error'] = sys.exc_info()
+                    return
+
+        workers = [threading.Thread(target=worker) for i in
+                   xrange(min(self.concurrency, len(deliveries)))]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        if state['error'] is not None:
+            raise state['error'][0], state['error'][1], state['error'][2]
+
+    def _session(self):
+        """
+        Return the shared session for our command, starting it if needed.
+        Must be called with _sessions_lock held.
+        """
+        session = _sessions.get(self.command)
+        if session is None:
+            session = SendmailSMTP(self.command)
+            session.connect()
+            _sessions[self.command] = session
+        return session
+
+    def _send_session(self, email_message, recipients):
+        """
+        Send through the shared session, restarting it once if sendmail
+        went away since the last message.
+        """
+        message = email_message.message()
+        with _sessions_lock:
+            try:
+                self._session().stream_message(email_message.from_email,
+                                               recipients, message)
+            except (smtplib.SMTPServerDisconnected, IOError, OSError):
+                session = _sessions.pop(self.command, None)
+                if session is not None:
+                    session.close()
+                self._session().stream_message(email_message.from_email,
+                                               recipients, message)
+        return True
+
+    def _send(self, email_message, recipients=None):
         """A helper method that does the actual sending."""
-        if not email_message.recipients():
+        if recipients is None:
+            recipients = email_message.recipients()
+        recipients = list(recipients)
+        if not recipients:
             return False
         try:
-            ps = Popen(["sendmail"]+list(email_message.recipients()), \
-                       stdin=PIPE)
-            ps.stdin.write(email_message.message().as_string())
-            ps.stdin.flush()
+            if self.persistent:
+                return self._send_session(email_message, recipients)
+            ps = Popen(list(self.command)+recipients, stdin=PIPE, bufsize=-1)
+            _StreamingGenerator(ps.stdin, mangle_from_=False).flatten(
+                email_message.message())
             ps.stdin.close()
             return not ps.wait()
         except:
             if not self.fail_silently:
                 raise
             return False
-        return True
\ No newline at end of file
+        return True
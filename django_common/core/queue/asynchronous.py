@@ -0,0 +1,99 @@
+"""Tornado coroutine wrapper around PersistentQueue."""
+
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen, ioloop, locks
+
+from .persistent import Empty
+
+
+__all__ = ['AsyncPersistentQueue']
+
+
+class AsyncPersistentQueue(object):
+    """
+    Runs the disk I/O of a PersistentQueue on a bounded thread pool so
+    that it never blocks the IOLoop. Use from coroutines:
+
+        item = yield queue.get()
+        yield queue.put(item)
+
+    Consumers waiting in get() are woken as soon as an item is put
+    through this wrapper. Items put by other processes into a
+    multiprocess queue are noticed every 'poll_interval' seconds of the
+    underlying queue.
+    """
+
+    def __init__(self, queue, executor=None, max_workers=1):
+        self.queue = queue
+        self.own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers)
+        self.not_empty = locks.Condition()
+        # Puts completed through this wrapper, so get_many() notices those
+        # that finished while its own get was running on the executor.
+        self.puts = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    @gen.coroutine
+    def put(self, obj):
+        yield self.executor.submit(self.queue.put, obj)
+        self.puts += 1
+        self.not_empty.notify()
+
+    @gen.coroutine
+    def put_many(self, objs):
+        yield self.executor.submit(self.queue.put_many, list(objs))
+        self.puts += 1
+        self.not_empty.notify_all()
+
+    @gen.coroutine
+    def get(self, timeout=None):
+        """
+        Remove and return an item from the queue, waiting at most
+        'timeout' seconds for one. Throws Empty exception on timeout.
+        """
+        result = yield self.get_many(1, timeout)
+        raise gen.Return(result[0])
+
+    @gen.coroutine
+    def get_many(self, max_items, timeout=None):
+        """
+        Get up to 'max_items' items as a list once at least one item is
+        available, waiting at most 'timeout' seconds.
+        """
+        io_loop = ioloop.IOLoop.current()
+        deadline = None
+        if timeout is not None:
+            deadline = io_loop.time() + timeout
+        while True:
+            puts = self.puts
+            try:
+                result = yield self.executor.submit(self.queue.get_many,
+                                                    max_items, False)
+                raise gen.Return(result)
+            except Empty:
+                pass
+            if deadline is not None and io_loop.time() >= deadline:
+                raise Empty
+            if self.puts != puts:
+                continue
+            wait = deadline
+            if self.queue.multiprocess:
+                poll = io_loop.time() + self.queue.poll_interval
+                wait = poll if deadline is None else min(deadline, poll)
+            yield self.not_empty.wait(wait)
+
+    @gen.coroutine
+    def sync(self):
+        yield self.executor.submit(self.queue.sync)
+
+    @gen.coroutine
+    def close(self):
+        """
+        Close the underlying queue. The executor is shut down too unless
+        it was passed in.
+        """
+        yield self.executor.submit(self.queue.close)
+        if self.own_executor:
+            self.executor.shutdown(wait=False)
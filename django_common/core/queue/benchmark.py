@@ -0,0 +1,216 @@
+"""
+Benchmarks for django_common.core.queue.persistent.
+
+Measures put and get throughput, p50/p99 latency and peak RSS of
+PersistentQueue for every combination of the given engines, cache
+sizes, item sizes, serializers, durability policies and thread counts,
+and writes the results as JSON:
+
+    python -m django_common.core.queue.benchmark --items 20000 \\
+        --cache-sizes 512,8192 --threads 1,4 --output results.json
+
+Every configuration runs in a forked child process where available, so
+peak RSS is measured per configuration.
+"""
+
+import json, os, resource, shutil, sys, tempfile, threading, time
+from optparse import OptionParser
+
+from .persistent import PersistentQueue, Empty, CacheStorage, LogStorage
+
+
+__all__ = ['run', 'run_all', 'main']
+
+
+def _percentile(latencies, percent):
+    if not latencies:
+        return 0.0
+    return latencies[int(round(percent / 100.0 * (len(latencies) - 1)))]
+
+def _summary(latencies, elapsed):
+    latencies.sort()
+    return {
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_us': _percentile(latencies, 50) * 1e6,
+        'p99_us': _percentile(latencies, 99) * 1e6,
+    }
+
+def _peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Reported in bytes rather than kilobytes
+        peak /= 1024
+    return peak
+
+def _timed(threads, work):
+    """
+    Run 'work(index, latencies)' on 'threads' threads and return the
+    latencies they recorded and the elapsed wall time.
+    """
+    latencies = [[] for index in xrange(threads)]
+    workers = [threading.Thread(target=work, args=(index, latencies[index]))
+               for index in xrange(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+    return sum(latencies, []), elapsed
+
+def run(directory, items, cache_size, item_size, threads, engine,
+        serializer=None, durability='none'):
+    """
+    Put 'items' items of 'item_size' bytes on a fresh queue in
+    'directory' from 'threads' threads, then get them all back the same
+    way. Returns a dict of results.
+    """
+    queue = PersistentQueue(directory, cache_size, engine=engine,
+                            serializer=serializer, durability=durability)
+    item = 'x' * item_size
+    per_thread = [items // threads + (index < items % threads)
+                  for index in xrange(threads)]
+
+    def produce(index, latencies):
+        for count in xrange(per_thread[index]):
+            start = time.time()
+            queue.put(item)
+            latencies.append(time.time() - start)
+
+    def consume(index, latencies):
+        for count in xrange(per_thread[index]):
+            start = time.time()
+            queue.get(timeout=60)
+            latencies.append(time.time() - start)
+
+    put_latencies, put_elapsed = _timed(threads, produce)
+    queue.sync()
+    get_latencies, get_elapsed = _timed(threads, consume)
+    queue.close()
+    return {
+        'engine': engine,
+        'serializer': serializer or 'marshal',
+        'durability': durability,
+        'cache_size': cache_size,
+        'item_size': item_size,
+        'threads': threads,
+        'items': items,
+        'put': _summary(put_latencies, put_elapsed),
+        'get': _summary(get_latencies, get_elapsed),
+        'peak_rss_kb': _peak_rss_kb(),
+    }
+
+def _isolated(**kwargs):
+    """
+    Run a benchmark in a child process so its peak RSS is its own.
+    """
+    if not hasattr(os, 'fork'):
+        return run(**kwargs)
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            try:
+                result = run(**kwargs)
+            except Exception, err:
+                result = {'error': repr(err)}
+                status = 1
+            os.write(write_fd, json.dumps(result))
+        finally:
+            os._exit(status)
+    os.close(write_fd)
+    chunks = []
+    while True:
+        chunk = os.read(read_fd, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    result = json.loads(''.join(chunks))
+    if 'error' in result:
+        raise RuntimeError('Benchmark %r failed: %s' %
+                           (kwargs, result['error']))
+    return result
+
+def run_all(items, cache_sizes, item_sizes, serializers, thread_counts,
+            engines, durabilities, directory=None):
+    """
+    Run every combination of the given parameters. The serializers only
+    apply to the log engine; the cache engine always uses marshal.
+    Returns a list of result dicts.
+    """
+    root = directory or tempfile.mkdtemp(prefix='persistent-benchmark-')
+    results = []
+    try:
+        for engine in engines:
+            if engine == LogStorage.engine:
+                engine_serializers = serializers
+            else:
+                engine_serializers = [None]
+            for serializer in engine_serializers:
+                for durability in durabilities:
+                    for cache_size in cache_sizes:
+                        for item_size in item_sizes:
+                            for threads in thread_counts:
+                                path = os.path.join(root, 'queue')
+                                shutil.rmtree(path, True)
+                                results.append(_isolated(
+                                    directory=path, items=items,
+                                    cache_size=cache_size,
+                                    item_size=item_size, threads=threads,
+                                    engine=engine, serializer=serializer,
+                                    durability=durability))
+    finally:
+        if directory is None:
+            shutil.rmtree(root, True)
+    return results
+
+def main(argv=None):
+    def ints(value):
+        return [int(each) for each in value.split(',')]
+    def names(value):
+        return value.split(',')
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--items', type='int', default=10000,
+                      help='Items put and got per configuration')
+    parser.add_option('--cache-sizes', default='64,512,4096',
+                      help='Comma separated cache sizes')
+    parser.add_option('--item-sizes', default='16,256,4096',
+                      help='Comma separated item sizes in bytes')
+    parser.add_option('--serializers', default='marshal,pickle,raw',
+                      help='Comma separated serializers for the log engine')
+    parser.add_option('--threads', default='1,4',
+                      help='Comma separated producer/consumer thread counts')
+    parser.add_option('--engines', default='%s,%s' % (CacheStorage.engine,
+                                                      LogStorage.engine),
+                      help='Comma separated storage engines')
+    parser.add_option('--durability', default='none',
+                      help='Comma separated durability policies')
+    parser.add_option('--directory', default=None,
+                      help='Directory to create queues in')
+    parser.add_option('--output', default=None,
+                      help='File to write JSON results to, default stdout')
+    options, args = parser.parse_args(argv)
+    results = run_all(options.items, ints(options.cache_sizes),
+                      ints(options.item_sizes), names(options.serializers),
+                      ints(options.threads), names(options.engines),
+                      names(options.durability), options.directory)
+    report = json.dumps({
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'results': results,
+    }, indent=2, sort_keys=True)
+    if options.output:
+        output = open(options.output, 'w')
+        try:
+            output.write(report)
+        finally:
+            output.close()
+    else:
+        print report
+
+if __name__ == '__main__':
+    main()
@@ -1,198 +1,1744 @@
-import os, sys, marshal, glob, thread
+import os, sys, marshal, glob, heapq, mmap, thread, threading, struct, time
+from collections import deque
+from itertools import islice
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # Filename used for index files, must not contain numbers
 INDEX_FILENAME = 'index'
 
+# Filename used for temporary files, must not contain numbers
+TEMP_FILENAME = 'tempfile'
+
+# Filename used for the inter-process lock, must not contain numbers
+LOCK_FILENAME = 'lock'
+
+# Filename used for the journal of reserved items, must not contain numbers
+INFLIGHT_FILENAME = 'inflight'
+
+# Filename used for the lane names of a priority queue
+LANES_FILENAME = 'lanes'
+
+# Filename used for the bitmap of priority queue lanes that may hold items
+READY_FILENAME = 'ready'
+
+# Record header used by the log engine: payload length, big endian
+RECORD_HEADER = struct.Struct('>I')
+
+# Bytes copied at a time when compacting a segment
+COPY_CHUNK_SIZE = 1 << 20
+
+# In-flight journal entry: operation, reservation id, deadline
+JOURNAL_ENTRY = struct.Struct('>cQd')
+
+# Seconds between checks for items put by other processes
+POLL_INTERVAL = 0.1
+
+# Seconds a reserved item stays invisible before it is redelivered
+VISIBILITY_TIMEOUT = 30
+
+# Durability policies, deciding when written data is fsync'd to disk
+DURABILITY_NONE = 'none'
+DURABILITY_EVERY_N_ITEMS = 'every_n_items'
+DURABILITY_INTERVAL_MS = 'interval_ms'
+DURABILITY_ALWAYS = 'always'
+DURABILITY_POLICIES = (DURABILITY_NONE, DURABILITY_EVERY_N_ITEMS,
+                       DURABILITY_INTERVAL_MS, DURABILITY_ALWAYS)
+
 # Exception thrown when calling get() on an empty queue
 class Empty(Exception):  pass
 
-class PersistentQueue:
+class Serializer(object):
+    """
+    Encodes single queue items to strings and back. The 'name' is
+    recorded in the index of queues using the serializer.
+    """
+    name = None
+
+    def dumps(self, obj):
+        raise NotImplementedError
+
+    def loads(self, data):
+        raise NotImplementedError
+
+class MarshalSerializer(Serializer):
+    name = 'marshal'
+
+    def dumps(self, obj):
+        return marshal.dumps(obj)
+
+    def loads(self, data):
+        return marshal.loads(data)
+
+class PickleSerializer(Serializer):
+    """
+    Pickles items with the highest protocol available.
+    """
+    name = 'pickle'
+
+    def dumps(self, obj):
+        return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+class RawSerializer(Serializer):
+    """
+    Stores byte strings as they are.
+    """
+    name = 'raw'
+
+    def dumps(self, obj):
+        if not isinstance(obj, str):
+            raise TypeError('The raw serializer only accepts str, not %s' %
+                            type(obj).__name__)
+        return obj
+
+    def loads(self, data):
+        return data
+
+class MsgpackSerializer(Serializer):
+    """
+    Packs items with msgpack, which must be installed separately.
+    """
+    name = 'msgpack'
+
+    def __init__(self):
+        import msgpack
+        self.packb = msgpack.packb
+        self.unpackb = msgpack.unpackb
 
-    def __init__(self, name, cache_size=512, marshal=marshal):
+    def dumps(self, obj):
+        return self.packb(obj)
+
+    def loads(self, data):
+        return self.unpackb(data)
+
+# Available serializers, keyed by the name recorded in the index
+SERIALIZERS = {
+    MarshalSerializer.name: MarshalSerializer,
+    PickleSerializer.name: PickleSerializer,
+    RawSerializer.name: RawSerializer,
+    MsgpackSerializer.name: MsgpackSerializer,
+}
+
+def _get_serializer(serializer):
+    """
+    Return a Serializer instance for a serializer name or instance.
+    """
+    if isinstance(serializer, Serializer):
+        return serializer
+    if serializer not in SERIALIZERS:
+        raise ValueError('Unknown queue serializer %r' % serializer)
+    return SERIALIZERS[serializer]()
+
+class SyncPolicy(object):
+    """
+    Decides when data written to a queue is fsync'd. Items written
+    between two fsyncs are committed as a group:
+
+        none           never fsync, leave it to the operating system
+        every_n_items  fsync once 'items' items have been written
+        interval_ms    fsync on the first write 'interval_ms' after the
+                       previous fsync; a PersistentQueue also fsyncs items
+                       still pending 'interval_ms' after they were written
+        always         fsync after every put() or put_many() call
+
+    Index updates are fsync'd, along with the queue directory, under
+    every policy but 'none' when segments are added or removed. The index
+    a shared queue writes after every operation is only fsync'd along
+    with the items.
+    """
+    def __init__(self, policy=DURABILITY_NONE, items=1000, interval_ms=100):
+        if policy not in DURABILITY_POLICIES:
+            raise ValueError('Unknown durability policy %r' % policy)
+        assert items > 0, 'Items must be larger than 0'
+        self.policy = policy
+        self.items = items
+        self.interval = interval_ms / 1000.0
+        self.enabled = policy != DURABILITY_NONE
+        self.pending = 0
+        self.synced = time.time()
+
+    def written(self, fileobj, count):
         """
-        Create a persistent FIFO queue named by the 'name' argument.
+        Record that 'count' items were written to 'fileobj' and fsync it
+        if the policy says the group is complete. Returns whether it was
+        fsync'd.
+        """
+        if not self.enabled:
+            return False
+        self.pending += count
+        if self.policy == DURABILITY_ALWAYS or \
+           (self.policy == DURABILITY_EVERY_N_ITEMS and
+            self.pending >= self.items) or \
+           (self.policy == DURABILITY_INTERVAL_MS and
+            time.time() - self.synced >= self.interval):
+            self.flush(fileobj)
+            return True
+        return False
 
-        The number of cached queue items at the head and tail of the queue
-        is determined by the optional 'cache_size' parameter.  By default
-        the marshal module is used to (de)serialize queue items, but you
-        may specify an alternative serialize module/instance with the
-        optional 'marshal' argument (e.g. pickle).
+    def flush(self, fileobj):
         """
-        assert cache_size > 0, 'Cache size must be larger than 0'
+        Fsync 'fileobj' if it has items written since the last fsync.
+        """
+        if self.enabled and self.pending:
+            fileobj.flush()
+            os.fsync(fileobj.fileno())
+        self.pending = 0
+        self.synced = time.time()
+
+def _fsync_dir(name):
+    fd = os.open(name, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _mkdir(name):
+    """
+    Create the directory 'name' unless it exists, tolerating a race with
+    another process creating it.
+    """
+    if not os.path.exists(name):
+        try:
+            os.mkdir(name)
+        except OSError:
+            if not os.path.isdir(name):
+                raise
+
+def _endtime(timeout):
+    """
+    Return the time a blocking call with 'timeout' seconds gives up.
+    """
+    if timeout is None:
+        return None
+    if timeout < 0:
+        raise ValueError('\'timeout\' must be a non-negative number')
+    return time.time() + timeout
+
+def _collect_garbage(name, head, tail):
+    """
+    Remove numbered files outside the live segments 'head' to 'tail' and
+    any leftover temp file from the queue directory 'name'. Returns the
+    number of bytes reclaimed.
+    """
+    reclaimed = 0
+    for filename in os.listdir(name):
+        if filename.isdigit():
+            if head <= int(filename) <= tail:
+                continue
+        elif filename != TEMP_FILENAME:
+            continue
+        path = os.path.join(name, filename)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            continue
+        reclaimed += size
+    return reclaimed
+
+def _read_index(index_file):
+    """
+    Read an index file written by _write_index.
+    Returns a (head, tail, options) tuple or None if there is no index.
+    """
+    if not os.path.exists(index_file):
+        return None
+    index = open(index_file)
+    try:
+        fields = index.read().split()
+    finally:
+        index.close()
+    head, tail = int(fields[0]), int(fields[1])
+    options = dict(field.split('=', 1) for field in fields[2:])
+    return head, tail, options
+
+def _write_index(index_file, temp_file, head, tail, options={},
+                 fsync=False):
+    """
+    Atomically replace the index file. The first two fields are always
+    the head and tail segment numbers, so old 'head tail' indexes remain
+    readable; engine specific state follows as key=value pairs.
+    """
+    fields = ['%d %d' % (head, tail)]
+    fields.extend('%s=%s' % item for item in sorted(options.items()))
+    index = open(temp_file, 'w')
+    index.write(' '.join(fields))
+    if fsync:
+        index.flush()
+        os.fsync(index.fileno())
+    index.close()
+    if os.path.exists(index_file):
+        os.remove(index_file)
+    os.rename(temp_file, index_file)
+    if fsync:
+        _fsync_dir(os.path.dirname(index_file) or '.')
+
+
+class CacheStorage(object):
+    """
+    Original storage engine. Every segment file holds a whole marshal'd
+    list of items; the head and tail segments are kept in memory and
+    rewritten as a whole when they are flushed.
+
+    The in-memory caches are deques so get() pops from the head in
+    constant time; they are converted to lists on disk.
+
+    Items only reach the disk when a cache is written, so a SyncPolicy
+    other than 'none' fsyncs every segment and index written, but cannot
+    make single puts durable.
+
+    The number of queued items is kept up to date on every operation and
+    stored in the index as 'count'. Indexes written when a cache rolls over
+    may not match the caches on disk after an unclean exit, so the count
+    is only trusted on open if sync() or close() wrote it last, marking the
+    index 'clean'; otherwise the segments are counted.
+
+    Only caches that changed since they were last loaded or written are
+    rewritten by sync().
+    """
+    engine = 'cache'
+
+    def __init__(self, name, cache_size, marshal, shared=False,
+                 serializer=None, sync_policy=None):
+        if shared:
+            raise ValueError('The %r engine keeps items in memory and '
+                             'cannot be shared between processes' %
+                             self.engine)
+        if serializer is not None:
+            raise ValueError('The %r engine stores whole caches with '
+                             '\'marshal\' and does not take a serializer' %
+                             self.engine)
         self.name = name
         self.cache_size = cache_size
         self.marshal = marshal
+        self.sync_policy = sync_policy or SyncPolicy()
         self.index_file = os.path.join(name, INDEX_FILENAME)
-        self.temp_file = os.path.join(name, 'tempfile')        
-        self.mutex = thread.allocate_lock()
-        self._init_index()
+        self.temp_file = os.path.join(name, TEMP_FILENAME)
 
-    def _init_index(self):
-        if not os.path.exists(self.name):
-            os.mkdir(self.name)
-        if os.path.exists(self.index_file):
-            index_file = open(self.index_file)
-            self.head, self.tail = map(lambda x: int(x),
-                                       index_file.read().split(' '))
-            index_file.close()
+    def _segment(self, num):
+        return os.path.join(self.name, str(num))
+
+    def open(self, index):
+        if index:
+            self.head, self.tail = index[0], index[1]
         else:
             self.head, self.tail = 0, 1
         def _load_cache(cache, num):
-            name = os.path.join(self.name, str(num))
+            name = self._segment(num)
             mode = 'rb+' if os.path.exists(name) else 'wb+'
             cachefile = open(name, mode)
             try:
-                setattr(self, cache, self.marshal.load(cachefile))
+                setattr(self, cache, deque(self.marshal.load(cachefile)))
             except EOFError:
-                setattr(self, cache, [])
+                setattr(self, cache, deque())
             cachefile.close()
         _load_cache('put_cache', self.tail)
         _load_cache('get_cache', self.head)
+        self.put_dirty = self.get_dirty = False
         assert self.head < self.tail, 'Head not less than tail'
+        if index and index[2].get('clean') == '1' and 'count' in index[2]:
+            self.count = int(index[2]['count'])
+            # Not clean anymore until the next sync()
+            self._sync_index()
+        else:
+            self.count = self._count()
+
+    def _count(self):
+        """
+        Count the queued items by loading every segment between the head
+        and tail caches, for indexes without a clean count.
+        """
+        count = len(self.get_cache) + len(self.put_cache)
+        for num in xrange(self.head + 1, self.tail):
+            cache_file = open(self._segment(num), 'rb')
+            try:
+                count += len(self.marshal.load(cache_file))
+            finally:
+                cache_file.close()
+        return count
 
-    def _sync_index(self):
+    def _sync_index(self, clean=False):
         assert self.head < self.tail, 'Head not less than tail'
-        index_file = open(self.temp_file, 'w')
-        index_file.write('%d %d' % (self.head, self.tail))
-        index_file.close()
-        if os.path.exists(self.index_file):
-            os.remove(self.index_file)
-        os.rename(self.temp_file, self.index_file)
+        options = {'count': self.count}
+        if clean:
+            options['clean'] = 1
+        _write_index(self.index_file, self.temp_file, self.head, self.tail,
+                     options, fsync=self.sync_policy.enabled)
 
-    def _split(self):
-        put_file = os.path.join(self.name, str(self.tail))
+    def _dump(self, cache, num):
         temp_file = open(self.temp_file, 'wb')
-        self.marshal.dump(self.put_cache, temp_file)
+        self.marshal.dump(list(cache), temp_file)
+        if self.sync_policy.enabled:
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
         temp_file.close()
-        if os.path.exists(put_file):
-            os.remove(put_file)
-        os.rename(self.temp_file, put_file)
+        cache_file = self._segment(num)
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+        os.rename(self.temp_file, cache_file)
+
+    def _split(self):
+        self._dump(self.put_cache, self.tail)
         self.tail += 1
         if len(self.put_cache) <= self.cache_size:
-            self.put_cache = []
+            self.put_cache = deque()
         else:
-            self.put_cache = self.put_cache[:self.cache_size]
+            self.put_cache = deque(islice(self.put_cache, self.cache_size))
+        self.put_dirty = bool(self.put_cache)
         self._sync_index()
 
     def _join(self):
         current = self.head + 1
         if current == self.tail:
             self.get_cache = self.put_cache
-            self.put_cache = []
+            self.put_cache = deque()
+            self.put_dirty = self.get_dirty = True
         else:
-            get_file = open(os.path.join(self.name, str(current)), 'rb')
-            self.get_cache = self.marshal.load(get_file)
+            get_file = open(self._segment(current), 'rb')
+            self.get_cache = deque(self.marshal.load(get_file))
             get_file.close()
+            self.get_dirty = False
             try:
-                os.remove(os.path.join(self.name, str(self.head)))
-            except:
+                os.remove(self._segment(self.head))
+            except OSError:
+                # Left for compact() to collect
                 pass
             self.head = current
         if self.head == self.tail:
             self.head = self.tail - 1
         self._sync_index()
 
-    def _sync(self):
+    def __len__(self):
+        return self.count
+
+    def put(self, obj):
+        self.put_cache.append(obj)
+        self.put_dirty = True
+        self.count += 1
+        if len(self.put_cache) >= self.cache_size:
+            self._split()
+
+    def put_many(self, objs):
+        size = len(self.put_cache)
+        self.put_cache.extend(objs)
+        self.count += len(self.put_cache) - size
+        self.put_dirty = True
+        if len(self.put_cache) < self.cache_size:
+            return
+        items = list(self.put_cache)
+        full = len(items) - len(items) % self.cache_size
+        for start in xrange(0, full, self.cache_size):
+            self._dump(items[start:start+self.cache_size], self.tail)
+            self.tail += 1
+        self.put_cache = deque(items[full:])
+        self.put_dirty = bool(self.put_cache)
         self._sync_index()
-        get_file = os.path.join(self.name, str(self.head))
+
+    def get(self):
+        if len(self.get_cache) == 0:
+            self._join()
+            if len(self.get_cache) == 0:
+                raise Empty
+        self.count -= 1
+        self.get_dirty = True
+        return self.get_cache.popleft()
+
+    def get_many(self, max_items):
+        items = []
+        while len(items) < max_items:
+            if not self.get_cache:
+                self._join()
+                if not self.get_cache:
+                    break
+            if max_items - len(items) >= len(self.get_cache):
+                items.extend(self.get_cache)
+                self.get_cache.clear()
+            else:
+                popleft = self.get_cache.popleft
+                items.extend(popleft() for i in xrange(max_items-len(items)))
+        if not items:
+            raise Empty
+        self.count -= len(items)
+        self.get_dirty = True
+        return items
+
+    def flush(self):
+        # Caches are fsync'd as they are written
+        pass
+
+    def sync(self):
+        if self.get_dirty:
+            self._dump(self.get_cache, self.head)
+            self.get_dirty = False
+        if self.put_dirty:
+            self._dump(self.put_cache, self.tail)
+            self.put_dirty = False
+        # Written last, so the count is only marked clean once the caches
+        # it describes are on disk
+        self._sync_index(clean=True)
+
+    def compact(self):
+        """
+        Rewrite the head segment without the items already consumed and
+        remove orphaned files. Returns the number of bytes reclaimed.
+        """
+        reclaimed = _collect_garbage(self.name, self.head, self.tail)
+        head_file = self._segment(self.head)
+        before = os.path.getsize(head_file)
+        self.sync()
+        return reclaimed + max(before - os.path.getsize(head_file), 0)
+
+    def close(self):
+        self.sync()
+
+
+class LogStorage(object):
+    """
+    Append-only storage engine. Items are appended to numbered segment
+    files as length-prefixed records, so a put costs a single write. The
+    consumer keeps a read offset into the head segment instead of
+    rewriting it; fully consumed segments are deleted. The head segment
+    is memory-mapped and records are decoded one at a time as they are
+    dequeued, so only the pages actually read become resident.
+
+    The index stores 'head tail' followed by the read position in the
+    head segment and the size of the tail segment. Segments roll over
+    after 'cache_size' records.
+
+    A 'shared' storage writes the index after every operation and must
+    be reload()ed before each one, so several processes can use it
+    while holding an exclusive lock.
+
+    Items are encoded one at a time with a Serializer, whose name is
+    recorded in the index as the codec of the queue.
+
+    Appends are fsync'd in groups as decided by the SyncPolicy; a tail
+    segment is always fsync'd before it is sealed.
+
+    The number of queued items is stored in the index as 'count'. Records
+    appended to the tail after the last index write are found when the
+    tail is scanned on open and added to it.
+
+    Sealed segments hold 'cache_size' records of the queue that wrote
+    them, which need not be the current one, or fewer once compact()
+    rewrote the head without its consumed records. The record count of
+    the head segment is therefore kept in the index, and counted from the
+    record headers whenever a new head segment is reached. Every
+    compact() bumps the 'generation' in the index, so other processes
+    sharing the queue know to map the rewritten head again.
+    """
+    engine = 'log'
+
+    def __init__(self, name, cache_size, marshal, shared=False,
+                 serializer=None, sync_policy=None):
+        self.name = name
+        self.cache_size = cache_size
+        self.marshal = marshal
+        self.shared = shared
+        self.serializer = serializer
+        self.sync_policy = sync_policy or SyncPolicy()
+        self.index_file = os.path.join(name, INDEX_FILENAME)
+        self.temp_file = os.path.join(name, TEMP_FILENAME)
+        self.put_file = None
+        self.get_map = None
+        self.flushed = False
+
+    def _segment(self, num):
+        return os.path.join(self.name, str(num))
+
+    def _scan(self, num):
+        """
+        Count the complete records in segment 'num' and truncate a
+        trailing partial record left behind by an interrupted write.
+        Returns a (records, bytes) tuple.
+        """
+        name = self._segment(num)
+        if not os.path.exists(name):
+            return 0, 0
+        count, offset = 0, 0
+        segment = open(name, 'rb')
+        try:
+            while True:
+                header = segment.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                size, = RECORD_HEADER.unpack(header)
+                if len(segment.read(size)) < size:
+                    break
+                offset += RECORD_HEADER.size + size
+                count += 1
+        finally:
+            segment.close()
+        if os.path.getsize(name) != offset:
+            segment = open(name, 'rb+')
+            segment.truncate(offset)
+            segment.close()
+        return count, offset
+
+    def open(self, index):
+        if index:
+            self.head, self.tail = index[0], index[1]
+            self.offset = int(index[2].get('offset', 0))
+            self.generation = int(index[2].get('generation', 0))
+        else:
+            self.head, self.tail, self.offset = 0, 0, 0
+            self.generation = 0
+        assert self.head <= self.tail, 'Head greater than tail'
+        codec = index and index[2].get('codec') or MarshalSerializer.name
+        if self.serializer is None:
+            self.serializer = codec
+        name = getattr(self.serializer, 'name', self.serializer)
+        if index and name != codec:
+            raise ValueError('Queue %r uses the %r serializer, not %r' %
+                             (self.name, codec, name))
+        self.serializer = _get_serializer(self.serializer)
+        self.tail_count, self.tail_size = self._scan(self.tail)
+        self.head_count = self.tail_count if self.head == self.tail \
+                          else self._scan(self.head)[0]
+        if index and 'read' in index[2]:
+            self.head_read = int(index[2]['read'])
+        else:
+            self.head_read = self._count_read()
+        if index and 'count' in index[2]:
+            self.count = int(index[2]['count']) + \
+                         self.tail_count - int(index[2]['records'])
+        elif self.head == self.tail:
+            self.count = self.tail_count - self.head_read
+        else:
+            self.count = (self.head_count - self.head_read) + \
+                         self.tail_count + \
+                         sum(self._count_records(num)
+                             for num in xrange(self.head + 1, self.tail))
+        self.put_file = open(self._segment(self.tail), 'ab', 0)
+        self._sync_index()
+
+    def reload(self):
+        """
+        Pick up changes another process made to a shared queue.
+        """
+        head, tail, options = _read_index(self.index_file)
+        offset = int(options['offset'])
+        generation = int(options.get('generation', 0))
+        if tail != self.tail:
+            self.put_file.close()
+            self.put_file = open(self._segment(tail), 'ab', 0)
+        if head != self.head or generation != self.generation:
+            # A new head segment, or the head was rewritten by compact()
+            self._unmap()
+        self.head, self.tail, self.offset = head, tail, offset
+        self.generation = generation
+        self.head_read = int(options['read'])
+        self.tail_count = int(options['records'])
+        if 'available' in options:
+            self.head_count = int(options['available'])
+        else:
+            self.head_count = self.tail_count if head == tail \
+                              else self._count_records(head)
+        self.tail_size = int(options['bytes'])
+        self.count = int(options['count'])
+        if os.fstat(self.put_file.fileno()).st_size != self.tail_size:
+            # Another process died in the middle of an append
+            self.put_file.truncate(self.tail_size)
+
+    def _count_read(self):
+        """
+        Number of records before the read offset in the head segment.
+        """
+        if not self.offset:
+            return 0
+        return self._count_records(self.head, self.offset)
+
+    def _count_records(self, num, end=None):
+        """
+        Number of records in segment 'num', or before its byte 'end',
+        found by walking the record headers.
+        """
+        count, offset = 0, 0
+        segment = open(self._segment(num), 'rb')
+        try:
+            while end is None or offset < end:
+                header = segment.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                size, = RECORD_HEADER.unpack(header)
+                segment.seek(size, os.SEEK_CUR)
+                offset += RECORD_HEADER.size + size
+                count += 1
+        finally:
+            segment.close()
+        return count
+
+    def _sync_index(self, fsync=True):
+        assert self.head <= self.tail, 'Head greater than tail'
+        _write_index(self.index_file, self.temp_file, self.head, self.tail,
+                     {'engine': self.engine, 'codec': self.serializer.name,
+                      'offset': self.offset, 'available': self.head_count,
+                      'read': self.head_read, 'records': self.tail_count,
+                      'bytes': self.tail_size, 'count': self.count,
+                      'generation': self.generation},
+                     fsync=fsync and self.sync_policy.enabled)
+
+    def _commit(self):
+        if self.shared:
+            # Only fsync'd along with the items: records appended after an
+            # index lost in a crash are found by the tail scan on open.
+            self._sync_index(fsync=self.flushed)
+        self.flushed = False
+
+    def _roll(self):
+        """
+        Start a new tail segment.
+        """
+        self.sync_policy.flush(self.put_file)
+        self.put_file.close()
+        self.tail += 1
+        self.tail_count = 0
+        self.tail_size = 0
+        self.put_file = open(self._segment(self.tail), 'ab', 0)
+        self._sync_index()
+
+    def _advance(self):
+        """
+        Drop the fully consumed head segment and move to the next one.
+        """
+        self._unmap()
+        try:
+            os.remove(self._segment(self.head))
+        except OSError:
+            # Left for compact() to collect
+            pass
+        self.head += 1
+        self.offset = 0
+        self.head_read = 0
+        self.head_count = self.tail_count if self.head == self.tail \
+                          else self._count_records(self.head)
+        self._sync_index()
+
+    def __len__(self):
+        return self.count
+
+    def _append(self, records):
+        """
+        Write encoded 'records' to the tail segment with a single write.
+        """
+        data = ''.join(records)
+        self.put_file.write(data)
+        self.tail_count += len(records)
+        self.tail_size += len(data)
+        self.count += len(records)
+        if self.head == self.tail:
+            self.head_count = self.tail_count
+        if self.sync_policy.written(self.put_file, len(records)):
+            self.flushed = True
+        if self.tail_count >= self.cache_size:
+            self._roll()
+
+    def _record(self, obj):
+        data = self.serializer.dumps(obj)
+        return RECORD_HEADER.pack(len(data)) + data
+
+    def put(self, obj):
+        self._append([self._record(obj)])
+        self._commit()
+
+    def put_many(self, objs):
+        records = []
+        for obj in objs:
+            records.append(self._record(obj))
+            if self.tail_count + len(records) >= self.cache_size:
+                self._append(records)
+                records = []
+        if records:
+            self._append(records)
+        self._commit()
+
+    def _map(self, end):
+        """
+        Return a map of the head segment covering at least 'end' bytes.
+        Sealed segments are mapped once; the tail segment is mapped again
+        when the consumer catches up with what was appended since.
+        """
+        if self.get_map is not None and len(self.get_map) >= end:
+            return self.get_map
+        self._unmap()
+        segment = open(self._segment(self.head), 'rb')
+        try:
+            self.get_map = mmap.mmap(segment.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+        finally:
+            segment.close()
+        return self.get_map
+
+    def _unmap(self):
+        if self.get_map is not None:
+            self.get_map.close()
+            self.get_map = None
+
+    def _read(self):
+        """
+        Read the next record payload from the head segment.
+        Returns None if the queue is empty.
+        """
+        while self.head_read >= self.head_count:
+            if self.head == self.tail:
+                return None
+            self._advance()
+        start = self.offset + RECORD_HEADER.size
+        size, = RECORD_HEADER.unpack_from(self._map(start), self.offset)
+        data = self._map(start + size)[start:start+size]
+        self.offset = start + size
+        self.head_read += 1
+        self.count -= 1
+        return data
+
+    def get(self):
+        data = self._read()
+        if data is None:
+            raise Empty
+        self._commit()
+        return self.serializer.loads(data)
+
+    def get_many(self, max_items):
+        items = []
+        while len(items) < max_items:
+            data = self._read()
+            if data is None:
+                break
+            items.append(self.serializer.loads(data))
+        if not items:
+            raise Empty
+        self._commit()
+        return items
+
+    def flush(self):
+        """
+        Fsync items appended since the last fsync.
+        """
+        self.sync_policy.flush(self.put_file)
+
+    def sync(self):
+        self.sync_policy.flush(self.put_file)
+        self._sync_index()
+
+    def compact(self):
+        """
+        Rewrite a sealed head segment without the records already read and
+        remove orphaned files. The tail segment is left alone while it is
+        also the head, since producers append to it. Returns the number
+        of bytes reclaimed.
+        """
+        reclaimed = _collect_garbage(self.name, self.head, self.tail)
+        if self.head == self.tail or not self.offset:
+            return reclaimed
+        head_file = self._segment(self.head)
+        start, size = self.offset, os.path.getsize(head_file)
+        self.head_count -= self.head_read
+        self.head_read = 0
+        self.offset = 0
+        self.generation += 1
+        # The index is written first: a crash before the rename redelivers
+        # the consumed records instead of losing unread ones.
+        self._sync_index()
+        segment = self._map(size)
         temp_file = open(self.temp_file, 'wb')
-        self.marshal.dump(self.get_cache, temp_file)
+        for chunk in xrange(start, size, COPY_CHUNK_SIZE):
+            temp_file.write(segment[chunk:min(chunk+COPY_CHUNK_SIZE, size)])
+        if self.sync_policy.enabled:
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
         temp_file.close()
-        if os.path.exists(get_file):
-            os.remove(get_file)
-        os.rename(self.temp_file, get_file)
-        put_file = os.path.join(self.name, str(self.tail))
+        self._unmap()
+        os.rename(self.temp_file, head_file)
+        reclaimed += start
+        return reclaimed
+
+    def close(self):
+        self.sync()
+        self._unmap()
+        self.put_file.close()
+
+
+class InflightTable(object):
+    """
+    Items handed out by PersistentQueue.reserve() and not acked yet,
+    indexed by reservation id, with a heap of their deadlines so expired
+    reservations are found without a scan.
+
+    Every change is appended to a journal file as a length-prefixed
+    entry. The journal is replayed on open and rewritten with only the
+    live reservations once most of its entries are obsolete.
+    """
+    RESERVE, ACK, NEXT_ID = 'R', 'A', 'I'
+
+    def __init__(self, name, sync_policy):
+        self.name = name
+        self.temp_file = os.path.join(os.path.dirname(name), TEMP_FILENAME)
+        self.sync_policy = sync_policy
+        self.journal = None
+
+    def __len__(self):
+        return len(self.table)
+
+    def open(self, codec):
+        """
+        Load the journal, encoding items with 'codec' (an object with
+        dumps and loads, such as marshal or a Serializer).
+        """
+        self.codec = codec
+        self._replay()
+        if self.entries > len(self.table) + 1:
+            self._rewrite()
+
+    def _replay(self):
+        self.table = {}
+        self.deadlines = []
+        self.next_id = 1
+        self.entries = 0
+        self.size = 0
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if not os.path.exists(self.name):
+            return
+        self.journal = open(self.name, 'ab', 0)
+        self._read()
+        if os.fstat(self.journal.fileno()).st_size != self.size:
+            # Drop an entry left incomplete by an interrupted write
+            self.journal.truncate(self.size)
+
+    def _read(self):
+        """
+        Apply the complete journal entries after the ones already read.
+        """
+        journal = open(self.name, 'rb')
+        try:
+            journal.seek(self.size)
+            while True:
+                header = journal.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                size, = RECORD_HEADER.unpack(header)
+                entry = journal.read(size)
+                if len(entry) < size:
+                    break
+                op, id, deadline = JOURNAL_ENTRY.unpack_from(entry)
+                if op == self.RESERVE:
+                    obj = self.codec.loads(entry[JOURNAL_ENTRY.size:])
+                    self.table[id] = (deadline, obj)
+                    heapq.heappush(self.deadlines, (deadline, id))
+                    self.next_id = max(self.next_id, id + 1)
+                elif op == self.ACK:
+                    self.table.pop(id, None)
+                elif op == self.NEXT_ID:
+                    self.next_id = max(self.next_id, id)
+                self.entries += 1
+                self.size += RECORD_HEADER.size + size
+        finally:
+            journal.close()
+
+    def reload(self):
+        """
+        Pick up reservations made by other processes sharing the queue.
+        """
+        try:
+            stat = os.stat(self.name)
+        except OSError:
+            return
+        if self.journal is None or \
+           stat.st_ino != os.fstat(self.journal.fileno()).st_ino:
+            # Created or rewritten by another process
+            self._replay()
+        elif stat.st_size > self.size:
+            self._read()
+
+    def _append(self, op, id, deadline=0, data=''):
+        if self.journal is None:
+            self.journal = open(self.name, 'ab', 0)
+        entry = JOURNAL_ENTRY.pack(op, id, deadline) + data
+        self.journal.write(RECORD_HEADER.pack(len(entry)) + entry)
+        self.entries += 1
+        self.size += RECORD_HEADER.size + len(entry)
+        self.sync_policy.written(self.journal, 1)
+
+    def _rewrite(self):
+        """
+        Replace the journal with one holding only live reservations.
+        Returns the number of bytes reclaimed.
+        """
+        before = self.size
+        entries = [JOURNAL_ENTRY.pack(self.NEXT_ID, self.next_id, 0)]
+        for id, (deadline, obj) in self.table.iteritems():
+            entries.append(JOURNAL_ENTRY.pack(self.RESERVE, id, deadline) +
+                           self.codec.dumps(obj))
+        data = ''.join(RECORD_HEADER.pack(len(entry)) + entry
+                       for entry in entries)
         temp_file = open(self.temp_file, 'wb')
-        self.marshal.dump(self.put_cache, temp_file)
+        temp_file.write(data)
+        if self.sync_policy.enabled:
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
         temp_file.close()
-        if os.path.exists(put_file):
-            os.remove(put_file)
-        os.rename(self.temp_file, put_file)
+        if self.journal is not None:
+            self.journal.close()
+        os.rename(self.temp_file, self.name)
+        self.journal = open(self.name, 'ab', 0)
+        self.entries = len(entries)
+        self.size = len(data)
+        return max(before - self.size, 0)
 
-    def __len__(self):
+    def reserve(self, obj, visibility_timeout):
         """
-        Return number of items in queue.
+        Record 'obj' as reserved for 'visibility_timeout' seconds under a
+        new id. Returns the reservation id.
+        """
+        id = self.next_id
+        self.next_id += 1
+        deadline = time.time() + visibility_timeout
+        self._append(self.RESERVE, id, deadline, self.codec.dumps(obj))
+        self.table[id] = (deadline, obj)
+        heapq.heappush(self.deadlines, (deadline, id))
+        return id
+
+    def release(self, id):
+        """
+        Forget the reservation 'id' and return its item.
+        """
+        if id not in self.table:
+            raise ValueError('Unknown reservation %r' % (id,))
+        deadline, obj = self.table.pop(id)
+        self._append(self.ACK, id)
+        if self.entries > 1000 and self.entries > 4 * len(self.table):
+            self._rewrite()
+        return obj
+
+    def next_deadline(self):
+        """
+        Return the earliest deadline of a live reservation, or None.
+        Heap entries of acked or renewed reservations are dropped here.
+        """
+        while self.deadlines:
+            deadline, id = self.deadlines[0]
+            entry = self.table.get(id)
+            if entry is not None and entry[0] == deadline:
+                return deadline
+            heapq.heappop(self.deadlines)
+        return None
+
+    def expired(self):
+        """
+        Return the id and item of a reservation whose deadline passed,
+        or None.
+        """
+        deadline = self.next_deadline()
+        if deadline is None or deadline > time.time():
+            return None
+        id = self.deadlines[0][1]
+        return id, self.table[id][1]
+
+    def flush(self):
+        """
+        Fsync entries appended since the last fsync.
+        """
+        if self.journal is not None:
+            self.sync_policy.flush(self.journal)
+
+    def compact(self):
+        if self.journal is None:
+            return 0
+        return self._rewrite()
+
+    def close(self):
+        if self.journal is not None:
+            self.sync_policy.flush(self.journal)
+            self.journal.close()
+            self.journal = None
+
+
+# Available storage engines, keyed by the name recorded in the index
+ENGINES = {
+    CacheStorage.engine: CacheStorage,
+    LogStorage.engine: LogStorage,
+}
+
+class PersistentQueue:
+
+    def __init__(self, name, cache_size=512, marshal=marshal, engine=None,
+                 multiprocess=False, poll_interval=POLL_INTERVAL,
+                 serializer=None, durability=DURABILITY_NONE,
+                 fsync_items=1000, fsync_interval_ms=100,
+                 visibility_timeout=VISIBILITY_TIMEOUT):
+        """
+        Create a persistent FIFO queue named by the 'name' argument.
+
+        The number of cached queue items at the head and tail of the queue
+        is determined by the optional 'cache_size' parameter.  By default
+        the marshal module is used to (de)serialize queue items, but you
+        may specify an alternative serialize module/instance with the
+        optional 'marshal' argument (e.g. pickle).
+
+        The optional 'engine' argument selects how items are stored on
+        disk: 'cache' (the default) rewrites whole marshal'd caches,
+        'log' appends length-prefixed records to segment files. Existing
+        queues are always opened with the engine they were created with.
+
+        The log engine encodes every item on its own with the optional
+        'serializer' argument, either a Serializer instance or one of the
+        names in SERIALIZERS ('marshal' by default, 'pickle', 'raw' or
+        'msgpack'). The serializer name is recorded in the index and used
+        when the queue is opened again. Giving a serializer makes 'log'
+        the default engine for new queues.
+
+        With 'multiprocess' set, every operation holds an fcntl lock on
+        the queue directory and re-reads the index, so several processes
+        may produce to and consume from the same queue. This requires
+        the 'log' engine, which is the default for new queues in this
+        mode. Blocking gets are woken immediately by puts from the same
+        process and check for puts from other processes every
+        'poll_interval' seconds.
+
+        The 'durability' argument chooses when writes are fsync'd: one
+        of 'none' (the default), 'every_n_items' (every 'fsync_items'
+        items), 'interval_ms' (at most every 'fsync_interval_ms'
+        milliseconds) or 'always'. See SyncPolicy.
+
+        Items taken with reserve() instead of get() stay in a persisted
+        in-flight table until they are ack()ed, and are redelivered by
+        reserve() once 'visibility_timeout' seconds have passed.
+        """
+        assert cache_size > 0, 'Cache size must be larger than 0'
+        if multiprocess and fcntl is None:
+            raise ValueError('Multiprocess queues require fcntl')
+        self.name = name
+        self.cache_size = cache_size
+        self.marshal = marshal
+        self.multiprocess = multiprocess
+        self.poll_interval = poll_interval
+        self.serializer = serializer
+        self.sync_policy = SyncPolicy(durability, fsync_items,
+                                      fsync_interval_ms)
+        self.visibility_timeout = visibility_timeout
+        self.inflight = InflightTable(os.path.join(name, INFLIGHT_FILENAME),
+                                      SyncPolicy(durability, fsync_items,
+                                                 fsync_interval_ms))
+        self.index_file = os.path.join(name, INDEX_FILENAME)
+        self.temp_file = os.path.join(name, TEMP_FILENAME)
+        self.lock_file = None
+        self.mutex = thread.allocate_lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.waiters = 0
+        self.flush_timer = None
+        self._init_index(engine)
+
+    def _init_index(self, engine):
+        _mkdir(self.name)
+        if self.multiprocess:
+            self.lock_file = open(os.path.join(self.name, LOCK_FILENAME), 'a')
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            index = _read_index(self.index_file)
+            if index:
+                recorded = index[2].get('engine', CacheStorage.engine)
+                if engine is not None and engine != recorded:
+                    raise ValueError('Queue %r uses the %r engine, not %r' %
+                                     (self.name, recorded, engine))
+                engine = recorded
+            elif engine is None:
+                if self.multiprocess or self.serializer is not None:
+                    engine = LogStorage.engine
+                else:
+                    engine = CacheStorage.engine
+            if engine not in ENGINES:
+                raise ValueError('Unknown queue engine %r' % engine)
+            self.storage = ENGINES[engine](self.name, self.cache_size,
+                                           self.marshal,
+                                           shared=self.multiprocess,
+                                           serializer=self.serializer,
+                                           sync_policy=self.sync_policy)
+            self.storage.open(index)
+            self.inflight.open(getattr(self.storage, 'serializer', None) or
+                               self.marshal)
+        finally:
+            if self.lock_file is not None:
+                fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _acquire(self):
+        """
+        Lock the queue against other threads and, in multiprocess mode,
+        against other processes, then bring the storage up to date.
         """
         self.mutex.acquire()
+        if self.lock_file is None:
+            return
         try:
-            return (((self.tail-self.head)-1)*self.cache_size) + \
-                    len(self.put_cache) + len(self.get_cache)
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                self.storage.reload()
+                self.inflight.reload()
+            except:
+                fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+                raise
+        except:
+            self.mutex.release()
+            raise
+
+    def _release(self):
+        self._schedule_flush()
+        if self.lock_file is not None:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+        self.mutex.release()
+
+    def _schedule_flush(self):
+        """
+        Under the 'interval_ms' policy, start a timer to fsync writes
+        still pending after the interval, in case no further write does.
+        """
+        if self.flush_timer is not None or \
+           self.sync_policy.policy != DURABILITY_INTERVAL_MS or \
+           not (self.sync_policy.pending or self.inflight.sync_policy.pending):
+            return
+        self.flush_timer = threading.Timer(self.sync_policy.interval,
+                                           self._flush)
+        self.flush_timer.daemon = True
+        self.flush_timer.start()
+
+    def _flush(self):
+        # Only the files written by this process are fsync'd, so the
+        # inter-process lock is not needed.
+        self.mutex.acquire()
+        try:
+            if self.flush_timer is threading.current_thread():
+                self.flush_timer = None
+                self.storage.flush()
+                self.inflight.flush()
         finally:
             self.mutex.release()
 
+    def _wait(self, block, endtime, wakeup=None):
+        """
+        Wait for a put while the queue is locked. Throws Empty exception
+        if 'block' is false or 'endtime' has passed. Returns early at
+        the time 'wakeup'.
+        """
+        if not block:
+            raise Empty
+        timeout = None
+        if endtime is not None:
+            timeout = endtime - time.time()
+            if timeout <= 0:
+                raise Empty
+        if wakeup is not None:
+            delay = max(wakeup - time.time(), 0)
+            if timeout is None or delay < timeout:
+                timeout = delay
+        self.waiters += 1
+        try:
+            if self.lock_file is None:
+                self.not_empty.wait(timeout)
+                return
+            # Other processes cannot notify us, so poll with the file lock
+            # released.
+            if timeout is None or timeout > self.poll_interval:
+                timeout = self.poll_interval
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+            try:
+                self.not_empty.wait(timeout)
+            finally:
+                fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+                self.storage.reload()
+                self.inflight.reload()
+        finally:
+            self.waiters -= 1
+
+    def __len__(self):
+        """
+        Return number of items in queue.
+        """
+        self._acquire()
+        try:
+            return len(self.storage)
+        finally:
+            self._release()
+
     def sync(self):
         """
         Synchronize memory caches to disk.
         """
-        self.mutex.acquire()
+        self._acquire()
         try:
-            self._sync()
+            self.storage.sync()
         finally:
-            self.mutex.release()
+            self._release()
 
     def put(self, obj):
         """
         Put the item 'obj' on the queue.
         """
-        self.mutex.acquire()
+        self._acquire()
         try:
-            self.put_cache.append(obj)
-            if len(self.put_cache) >= self.cache_size:
-                self._split()
+            self.storage.put(obj)
+            if self.waiters:
+                self.not_empty.notify()
         finally:
-            self.mutex.release()
+            self._release()
 
-    def get(self):
+    def put_many(self, objs):
+        """
+        Put every item of the iterable 'objs' on the queue. The queue is
+        locked once and full segments are written in bulk.
+        """
+        self._acquire()
+        try:
+            self.storage.put_many(objs)
+            if self.waiters:
+                self.not_empty.notifyAll()
+        finally:
+            self._release()
+
+    def get(self, block=True, timeout=None):
+        """
+        Remove and return an item from the queue.
+
+        If 'block' is true and 'timeout' is None (the default), block
+        until an item is available. If 'timeout' is a positive number,
+        block at most 'timeout' seconds. Throws Empty exception if no
+        item was available within that time, or immediately if 'block'
+        is false.
+        """
+        endtime = _endtime(timeout)
+        self._acquire()
+        try:
+            while True:
+                try:
+                    return self.storage.get()
+                except Empty:
+                    self._wait(block, endtime)
+        finally:
+            self._release()
+
+    def get_nowait(self):
         """
-        Get an item from the queue.
+        Get an item from the queue without blocking.
         Throws Empty exception if the queue is empty.
         """
-        self.mutex.acquire()
+        return self.get(False)
+
+    def get_many(self, max_items, block=True, timeout=None):
+        """
+        Get up to 'max_items' items from the queue as a list. Blocks like
+        get() until at least one item is available.
+        """
+        assert max_items > 0, 'Max items must be larger than 0'
+        endtime = _endtime(timeout)
+        self._acquire()
         try:
-            if len(self.get_cache) > 0:
-                return self.get_cache.pop(0)
-            else:
-                self._join()
-                if len(self.get_cache) > 0:
-                    return self.get_cache.pop(0)
+            while True:
+                try:
+                    return self.storage.get_many(max_items)
+                except Empty:
+                    self._wait(block, endtime)
+        finally:
+            self._release()
+
+    def reserve(self, block=True, timeout=None, visibility_timeout=None):
+        """
+        Remove an item from the queue and hold it in the in-flight table
+        until it is ack()ed. Returns a (reservation id, item) tuple.
+
+        Reservations not acked within 'visibility_timeout' seconds (the
+        queue's visibility_timeout by default) are handed out again by
+        later reserve() calls, before any new items, under a new id; a
+        late ack() or nack() of the old id throws ValueError instead of
+        touching the new reservation. Blocks and throws Empty exception
+        like get().
+        """
+        if visibility_timeout is None:
+            visibility_timeout = self.visibility_timeout
+        endtime = _endtime(timeout)
+        self._acquire()
+        try:
+            while True:
+                expired = self.inflight.expired()
+                if expired:
+                    id, obj = expired
+                    self.inflight.release(id)
+                    return self.inflight.reserve(obj, visibility_timeout), obj
+                try:
+                    obj = self.storage.get()
+                except Empty:
+                    self._wait(block, endtime, self.inflight.next_deadline())
                 else:
-                    raise Empty
+                    return self.inflight.reserve(obj, visibility_timeout), obj
         finally:
-            self.mutex.release()
+            self._release()
+
+    def ack(self, id):
+        """
+        Mark the reserved item 'id' as done and forget it.
+        Throws ValueError if 'id' is not reserved.
+        """
+        self._acquire()
+        try:
+            self.inflight.release(id)
+        finally:
+            self._release()
+
+    def nack(self, id, obj=None):
+        """
+        Give up the reserved item 'id' and put it, or 'obj' in its place,
+        back on the queue. Throws ValueError if 'id' is not reserved.
+        """
+        self._acquire()
+        try:
+            item = self.inflight.release(id)
+            self.storage.put(item if obj is None else obj)
+            if self.waiters:
+                self.not_empty.notify()
+        finally:
+            self._release()
+
+    def compact(self):
+        """
+        Reclaim disk space: rewrite the head segment without the items
+        already consumed, remove segments and temp files left behind by
+        failed deletes or interrupted writes and rewrite the in-flight
+        journal. Returns the number of bytes reclaimed.
+        """
+        self._acquire()
+        try:
+            return self.storage.compact() + self.inflight.compact()
+        finally:
+            self._release()
 
     def close(self):
         """
         Close the queue.  Implicitly synchronizes memory caches to disk.
         No further accesses should be made through this queue instance.
         """
-        self.mutex.acquire()
+        self._acquire()
         try:
-            self._sync()
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            self.storage.close()
+            self.inflight.close()
             if os.path.exists(self.temp_file):
                 try:
                     os.remove(self.temp_file)
                 except:
                     pass
+        finally:
+            self._release()
+            if self.lock_file is not None:
+                self.lock_file.close()
+
+class PriorityPersistentQueue(object):
+
+    def __init__(self, name, lanes, **kwargs):
+        """
+        Create a set of persistent FIFO queues, one per lane, under the
+        directory named by the 'name' argument.
+
+        The 'lanes' argument is either a number of lanes, numbered from 0
+        (the highest priority), or a sequence of topic names in order of
+        decreasing priority. Every lane is a PersistentQueue in its own
+        subdirectory, created with the remaining keyword arguments.
+
+        get() returns the oldest item of the highest priority lane that
+        has one. Lanes holding items are kept in a heap, so this costs
+        O(log lanes) rather than a scan of every lane. In multiprocess
+        mode other processes may put items into any lane, so lanes that
+        may hold items are marked in a bitmap file shared by every
+        process instead, and a get reads that file rather than every
+        lane.
+
+        The lane names are recorded in the directory when it is created;
+        opening it with other lanes throws ValueError.
+        """
+        if isinstance(lanes, (int, long)):
+            lanes = range(lanes)
+        assert len(lanes) > 0, 'At least one lane is required'
+        for lane in lanes:
+            if not str(lane) or os.sep in str(lane) or '\n' in str(lane) or \
+               str(lane) in (os.curdir, os.pardir, LOCK_FILENAME,
+                             LANES_FILENAME, READY_FILENAME, TEMP_FILENAME):
+                raise ValueError('Invalid lane name %r' % (lane,))
+        self.multiprocess = kwargs.get('multiprocess', False)
+        if self.multiprocess and fcntl is None:
+            raise ValueError('Multiprocess queues require fcntl')
+        _mkdir(name)
+        self.name = name
+        self.lanes = dict((lane, priority)
+                          for priority, lane in enumerate(lanes))
+        self.lock_file = None
+        self.ready_file = None
+        if self.multiprocess:
+            self.lock_file = open(os.path.join(name, LOCK_FILENAME), 'a')
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            self._check_lanes([str(lane) for lane in lanes])
+            self.queues = [PersistentQueue(os.path.join(name, str(lane)),
+                                           **kwargs)
+                           for lane in lanes]
+            if self.multiprocess:
+                self._open_ready()
+        finally:
+            if self.lock_file is not None:
+                fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+        self.poll_interval = kwargs.get('poll_interval', POLL_INTERVAL)
+        self.mutex = thread.allocate_lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.waiters = 0
+        self._refresh()
+
+    def _check_lanes(self, names):
+        """
+        Record the lane 'names' in the queue directory, or check them
+        against the ones recorded when it was created.
+        """
+        lanes_file = os.path.join(self.name, LANES_FILENAME)
+        if os.path.exists(lanes_file):
+            f = open(lanes_file)
+            try:
+                recorded = f.read().split('\n')
+            finally:
+                f.close()
+            if recorded != names:
+                raise ValueError('Queue %r has lanes %r, not %r' %
+                                 (self.name, recorded, names))
+            return
+        temp_file = os.path.join(self.name, TEMP_FILENAME)
+        f = open(temp_file, 'w')
+        try:
+            f.write('\n'.join(names))
+        finally:
+            f.close()
+        os.rename(temp_file, lanes_file)
+
+    def _open_ready(self):
+        """
+        Open the shared bitmap of lanes that may hold items, one '0' or
+        '1' byte per lane. Lanes holding items are marked on open, in case
+        they were filled without multiprocess set or the bitmap was lost.
+        """
+        ready_file = os.path.join(self.name, READY_FILENAME)
+        if not os.path.exists(ready_file):
+            open(ready_file, 'w').close()
+        self.ready_file = open(ready_file, 'r+b')
+        ready = self.ready_file.read()
+        ready = ''.join(
+            '1' if ready[priority:priority + 1] == '1' or len(queue) else '0'
+            for priority, queue in enumerate(self.queues))
+        self.ready_file.seek(0)
+        self.ready_file.write(ready)
+        self.ready_file.truncate()
+        self.ready_file.flush()
+
+    def _refresh(self):
+        """
+        Rebuild the heap of lanes that hold items.
+        """
+        if self.lock_file is not None:
+            self.ready = []
+        else:
+            self.ready = [priority
+                          for priority, queue in enumerate(self.queues)
+                          if len(queue)]
+        self.ready_set = set(self.ready)
+
+    def _priority(self, lane):
+        if lane not in self.lanes:
+            raise ValueError('Unknown lane %r' % (lane,))
+        return self.lanes[lane]
+
+    def _ready(self, priority):
+        if self.lock_file is not None:
+            # Marked only after the item is in the lane, so a get that
+            # finds the lane empty can't clear the mark of a later put.
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                self.ready_file.seek(priority)
+                self.ready_file.write('1')
+                self.ready_file.flush()
+            finally:
+                fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+        elif priority not in self.ready_set:
+            heapq.heappush(self.ready, priority)
+            self.ready_set.add(priority)
+        if self.waiters:
+            self.not_empty.notify()
+
+    def _get_shared(self):
+        """
+        Take an item from the highest priority lane marked in the shared
+        bitmap, clearing the marks of lanes found empty.
+        """
+        fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            self.ready_file.seek(0)
+            ready = self.ready_file.read()
+            priority = ready.find('1')
+            while priority != -1:
+                try:
+                    return self.queues[priority].get(False)
+                except Empty:
+                    self.ready_file.seek(priority)
+                    self.ready_file.write('0')
+                    self.ready_file.flush()
+                priority = ready.find('1', priority + 1)
+            raise Empty
+        finally:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _wait(self, block, endtime):
+        if not block:
+            raise Empty
+        timeout = None
+        if endtime is not None:
+            timeout = endtime - time.time()
+            if timeout <= 0:
+                raise Empty
+        if self.multiprocess and \
+           (timeout is None or timeout > self.poll_interval):
+            timeout = self.poll_interval
+        self.waiters += 1
+        try:
+            self.not_empty.wait(timeout)
+        finally:
+            self.waiters -= 1
+
+    def __len__(self):
+        """
+        Return number of items in all lanes.
+        """
+        return sum(len(queue) for queue in self.queues)
+
+    def put(self, obj, lane):
+        """
+        Put the item 'obj' on the queue of 'lane'.
+        """
+        priority = self._priority(lane)
+        self.mutex.acquire()
+        try:
+            self.queues[priority].put(obj)
+            self._ready(priority)
+        finally:
+            self.mutex.release()
+
+    def put_many(self, objs, lane):
+        """
+        Put every item of the iterable 'objs' on the queue of 'lane'.
+        """
+        priority = self._priority(lane)
+        self.mutex.acquire()
+        try:
+            queue = self.queues[priority]
+            queue.put_many(objs)
+            if len(queue):
+                self._ready(priority)
+        finally:
+            self.mutex.release()
+
+    def get(self, block=True, timeout=None):
+        """
+        Remove and return the next item of the highest priority lane that
+        has one. Blocks and throws Empty exception like
+        PersistentQueue.get().
+        """
+        endtime = _endtime(timeout)
+        self.mutex.acquire()
+        try:
+            while True:
+                if self.lock_file is not None:
+                    try:
+                        return self._get_shared()
+                    except Empty:
+                        pass
+                while self.ready:
+                    priority = self.ready[0]
+                    try:
+                        return self.queues[priority].get(False)
+                    except Empty:
+                        # Lanes are dropped from the heap once found empty
+                        heapq.heappop(self.ready)
+                        self.ready_set.discard(priority)
+                self._wait(block, endtime)
         finally:
             self.mutex.release()
 
+    def get_nowait(self):
+        """
+        Get an item without blocking.
+        Throws Empty exception if every lane is empty.
+        """
+        return self.get(False)
+
+    def sync(self):
+        """
+        Synchronize memory caches of every lane to disk.
+        """
+        for queue in self.queues:
+            queue.sync()
+
+    def compact(self):
+        """
+        Compact every lane. Returns the number of bytes reclaimed.
+        """
+        return sum(queue.compact() for queue in self.queues)
+
+    def close(self):
+        """
+        Close every lane.
+        """
+        for queue in self.queues:
+            queue.close()
+        if self.ready_file is not None:
+            self.ready_file.close()
+        if self.lock_file is not None:
+            self.lock_file.close()
+
 ## Tests
 if __name__ == "__main__":
     ELEMENTS = 1000
-    p = PersistentQueue('test', 10)
-    print 'Enqueueing %d items, cache size = %d' % (ELEMENTS,
-                                                    p.cache_size)
-    for a in range(ELEMENTS):
-        p.put(str(a))
-    p.sync()
-    print 'Queue length (using __len__):', len(p)
-    print 'Dequeueing %d items' % (ELEMENTS/2)
-    for a in range(ELEMENTS/2):
-        p.get()
-    print 'Queue length (using __len__):', len(p)
-    print 'Dequeueing %d items' % (ELEMENTS/2)
-    for a in range(ELEMENTS/2):
-        p.get()
-    print 'Queue length (using __len__):', len(p)
-    p.sync()
-    p.close()
\ No newline at end of file
+    for engine in ENGINES:
+        p = PersistentQueue('test-%s' % engine, 10, engine=engine)
+        print 'Enqueueing %d items, cache size = %d, engine = %s' % \
+              (ELEMENTS, p.cache_size, engine)
+        for a in range(ELEMENTS):
+            p.put(str(a))
+        p.sync()
+        print 'Queue length (using __len__):', len(p)
+        print 'Dequeueing %d items' % (ELEMENTS/2)
+        for a in range(ELEMENTS/2):
+            p.get()
+        print 'Queue length (using __len__):', len(p)
+        print 'Dequeueing %d items' % (ELEMENTS/2)
+        for a in range(ELEMENTS/2):
+            p.get()
+        print 'Queue length (using __len__):', len(p)
+        p.sync()
+        p.close()
+    p = PersistentQueue('test-reserve', 10, engine='log')
+    print 'Reserving an item and letting its visibility timeout pass'
+    p.put('item')
+    first, item = p.reserve(visibility_timeout=0.1)
+    time.sleep(0.2)
+    second, item = p.reserve(False)
+    assert second != first, 'Redelivered under the same id'
+    try:
+        p.ack(first)
+    except ValueError:
+        print 'Late ack of the first reservation rejected'
+    else:
+        raise AssertionError('Late ack accepted')
+    p.ack(second)
+    print 'Reserved items (using len(p.inflight)):', len(p.inflight)
+    p.close()